@@ -1,21 +1,32 @@
 import asyncio
+import contextlib
+import contextvars
+import copy
+import functools
 import glob
 import hashlib
+import heapq
 import http.cookiejar as cookiejar
 import json
 import logging
 import os
 import re
 import shutil
+import sqlite3
 import subprocess
 import threading
 import time
+from collections import Counter, deque
+from concurrent.futures import FIRST_EXCEPTION, Future, ThreadPoolExecutor, wait
+from concurrent.futures import TimeoutError as FutureTimeoutError
 from contextlib import ExitStack
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Any, Iterable
+from typing import Any, Callable, Iterable
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
 
 import requests
+from requests.adapters import HTTPAdapter
 from dotenv import load_dotenv
 from telegram import (
     InputFile,
@@ -32,7 +43,7 @@ from telegram.ext import (
     filters,
 )
 from yt_dlp import YoutubeDL
-from yt_dlp.utils import DownloadError
+from yt_dlp.utils import DownloadCancelled, DownloadError, ReExtractInfo, encode_base_n
 
 # -------------------------
 # Environment & logging
@@ -51,11 +62,33 @@ logger = logging.getLogger(__name__)
 TOKEN = os.getenv("TOKEN") or os.getenv("BOT_TOKEN")
 ADMIN_ID = int((os.getenv("ADMIN_ID") or "0").strip() or "0")
 
+# Self-hosted telegram-bot-api server instead of api.telegram.org, e.g. http://telegram-bot-api:8081
+TELEGRAM_API_BASE_URL = (os.getenv("TELEGRAM_API_BASE_URL") or "").strip().rstrip("/")
+# The server runs with --local: media is sent as file:// paths (the server must see the same
+# CACHE_DIR path) and uploads may be up to 2000 MB instead of 50 MB
+TELEGRAM_LOCAL_MODE = bool(TELEGRAM_API_BASE_URL) and (os.getenv("TELEGRAM_LOCAL_MODE", "0").strip() == "1")
+TELEGRAM_UPLOAD_LIMIT_MB = 2000 if TELEGRAM_LOCAL_MODE else 50
+# Read/media write timeout of Bot API requests (a local server answers only after its own upload);
+# 0 keeps the library defaults
+TELEGRAM_UPLOAD_TIMEOUT_SECONDS = float(
+    os.getenv("TELEGRAM_UPLOAD_TIMEOUT_SECONDS") or ("600" if TELEGRAM_LOCAL_MODE else "0")
+)
+
 DATA_DIR = Path(os.getenv("DATA_DIR", "data"))
 USERS_FILE = DATA_DIR / "users.txt"
+USERS_FLUSH_INTERVAL_SECONDS = int(os.getenv("USERS_FLUSH_INTERVAL_SECONDS", "30"))
 IG_USER_COOKIES_DIR = DATA_DIR / "ig_user_cookies"
+# Alphabet of Instagram shortcodes (a media pk in base 64), as used by yt-dlp for entry ids
+IG_SHORTCODE_CHARS = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-_"
 MAX_COOKIE_UPLOAD_SIZE_MB = int(os.getenv("MAX_COOKIE_UPLOAD_SIZE_MB", "2"))
 EXPECTING_IG_COOKIE_KEY = "awaiting_instagram_cookie_upload"
+QUEUE_FULL_TEXT = "Слишком много ссылок в очереди этого чата. Подожди, пока обработаются предыдущие."
+DOWNLOAD_FAILURE_TEXTS = {
+    "permanent": "Не удалось загрузить: публикация удалена, закрыта или недоступна в этой стране.",
+    "rate_limited": "Сервис временно ограничил запросы. Попробуй позже.",
+    "transient": "Не удалось загрузить из-за сетевой ошибки. Попробуй ещё раз.",
+}
+DOWNLOAD_FAILURE_DEFAULT_TEXT = "Не удалось загрузить. Возможно пора обновить cookies"
 
 # Runtime mode
 WEBHOOK_URL = (os.getenv("WEBHOOK_URL") or "").strip()
@@ -66,17 +99,65 @@ WEBHOOK_SECRET_TOKEN = (os.getenv("WEBHOOK_SECRET_TOKEN") or "").strip()
 
 # Cache settings
 CACHE_DIR = Path(os.getenv("CACHE_DIR", str(DATA_DIR / "cache")))
+CACHE_DB_PATH = Path(os.getenv("CACHE_DB_PATH", str(DATA_DIR / "cache.sqlite3")))
 CACHE_TTL_SECONDS = int(os.getenv("CACHE_TTL_SECONDS", "300"))  # 5 minutes by default
+# Telegram file_ids outlive local files: metadata-only entries are kept much longer
+CACHE_FILE_ID_TTL_SECONDS = int(os.getenv("CACHE_FILE_ID_TTL_SECONDS", str(14 * 24 * 3600)))
+# Byte budget for local cache files (0 = unlimited); popular entries are evicted last
+CACHE_MAX_BYTES = int(os.getenv("CACHE_MAX_BYTES", str(2 * 1024 * 1024 * 1024)))
+# Each hit extends local files lifetime by CACHE_TTL_SECONDS, but never past created_at + this cap
+CACHE_MAX_TTL_SECONDS = int(os.getenv("CACHE_MAX_TTL_SECONDS", str(6 * 3600)))
 CACHE_CLEAN_INTERVAL_SECONDS = int(os.getenv("CACHE_CLEAN_INTERVAL_SECONDS", "60"))
+# Per-link work directories. Kept on the same filesystem as CACHE_DIR / TRANSCODE_CACHE_DIR so
+# finished files are renamed or hard-linked into the caches instead of copied
+WORK_DIR = Path(os.getenv("WORK_DIR", str(DATA_DIR / "work")))
+# Transcode outputs keyed by source content hash + ffmpeg parameters (reposts of the same video
+# are encoded once); separate byte budget, least recently used outputs are dropped first
+TRANSCODE_CACHE_ENABLED = (os.getenv("TRANSCODE_CACHE_ENABLED", "1").strip() != "0")
+TRANSCODE_CACHE_DIR = Path(os.getenv("TRANSCODE_CACHE_DIR", str(DATA_DIR / "transcode_cache")))
+TRANSCODE_CACHE_MAX_BYTES = int(os.getenv("TRANSCODE_CACHE_MAX_BYTES", str(1024 * 1024 * 1024)))
+
+# Short/share links (vt.tiktok.com, vk.cc, ...) are resolved once and memoized
+SHORT_LINK_TIMEOUT_SECONDS = float(os.getenv("SHORT_LINK_TIMEOUT_SECONDS", "10"))
+SHORT_LINK_CACHE_TTL_SECONDS = int(os.getenv("SHORT_LINK_CACHE_TTL_SECONDS", "86400"))
+SHORT_LINK_CACHE_MAX_ENTRIES = max(1, int(os.getenv("SHORT_LINK_CACHE_MAX_ENTRIES", "2048")))
 
 # Downloader limits
 MAX_CONCURRENT_DOWNLOADS = int(os.getenv("MAX_CONCURRENT_DOWNLOADS", "5"))
 MAX_DURATION_SEC = int(os.getenv("MAX_DURATION_SEC", "600"))
 # Backward-compatible: older env used MAX_UPLOAD_MB
 MAX_SIZE_MB = int((os.getenv("MAX_SIZE_MB") or os.getenv("MAX_UPLOAD_MB") or "48").strip())
+if MAX_SIZE_MB > TELEGRAM_UPLOAD_LIMIT_MB:
+    logger.warning(
+        f"MAX_SIZE_MB={MAX_SIZE_MB} больше лимита Bot API ({TELEGRAM_UPLOAD_LIMIT_MB} MB), использую {TELEGRAM_UPLOAD_LIMIT_MB}"
+    )
+    MAX_SIZE_MB = TELEGRAM_UPLOAD_LIMIT_MB
 MAX_ITEMS_PER_LINK = int(os.getenv("MAX_ITEMS_PER_LINK", "10"))
+# Entries of one Instagram carousel / story set are downloaded concurrently, at most this many at once;
+# photos are fetched directly from the extracted image URLs
+IG_CAROUSEL_PARALLEL = max(1, int(os.getenv("IG_CAROUSEL_PARALLEL", "4")))
+PHOTO_DOWNLOAD_TIMEOUT_SECONDS = float(os.getenv("PHOTO_DOWNLOAD_TIMEOUT_SECONDS", "30"))
 TRY_NO_COOKIES_FIRST = (os.getenv("TRY_NO_COOKIES_FIRST", "1").strip() != "0")
 
+# Priority lanes: short/small media never queue behind long videos
+FAST_LANE_SLOTS = max(1, int(os.getenv("FAST_LANE_SLOTS", str(MAX_CONCURRENT_DOWNLOADS))))
+HEAVY_LANE_SLOTS = max(1, int(os.getenv("HEAVY_LANE_SLOTS", str(max(1, MAX_CONCURRENT_DOWNLOADS // 2)))))
+FAST_LANE_MAX_DURATION_SEC = int(os.getenv("FAST_LANE_MAX_DURATION_SEC", "90"))
+FAST_LANE_MAX_FILESIZE_MB = int(os.getenv("FAST_LANE_MAX_FILESIZE_MB", "20"))
+
+# Pipeline stages: each one has its own worker pool
+PIPELINE_EXTRACT_WORKERS = max(1, int(os.getenv("PIPELINE_EXTRACT_WORKERS", str(MAX_CONCURRENT_DOWNLOADS))))
+PIPELINE_DOWNLOAD_WORKERS = max(1, int(os.getenv("PIPELINE_DOWNLOAD_WORKERS", str(FAST_LANE_SLOTS + HEAVY_LANE_SLOTS))))
+PIPELINE_PROCESS_WORKERS = max(1, int(os.getenv("PIPELINE_PROCESS_WORKERS", "2")))
+PIPELINE_UPLOAD_WORKERS = max(1, int(os.getenv("PIPELINE_UPLOAD_WORKERS", str(MAX_CONCURRENT_DOWNLOADS))))
+
+# Fair scheduling of download jobs between chats, with token-bucket quotas (0 disables a quota)
+SCHEDULER_MAX_QUEUED_PER_CHAT = max(1, int(os.getenv("SCHEDULER_MAX_QUEUED_PER_CHAT", "10")))
+USER_QUOTA_PER_MINUTE = float(os.getenv("USER_QUOTA_PER_MINUTE", "6"))
+USER_QUOTA_BURST = max(1, int(os.getenv("USER_QUOTA_BURST", "5")))
+CHAT_QUOTA_PER_MINUTE = float(os.getenv("CHAT_QUOTA_PER_MINUTE", "30"))
+CHAT_QUOTA_BURST = max(1, int(os.getenv("CHAT_QUOTA_BURST", "15")))
+
 # Network / special cases
 RU_PROXY = os.getenv("RU_PROXY")
 YA_COOKIES_FILE = os.getenv("YA_COOKIES_FILE")
@@ -93,6 +174,11 @@ DEFAULT_VIDEO_FORMAT = (
 VIDEO_FORMAT = os.getenv("VIDEO_FORMAT", DEFAULT_VIDEO_FORMAT)
 VIDEO_FORMAT_FALLBACK = os.getenv("VIDEO_FORMAT_FALLBACK", "bestvideo*+bestaudio/best")
 MERGE_OUTPUT_FORMAT = os.getenv("MERGE_OUTPUT_FORMAT", "mp4")
+# Pick formats from the extracted list so the file fits MAX_SIZE_MB and needs no iOS transcode
+# (VIDEO_FORMAT is then used only when the formats carry no usable metadata)
+SIZE_AWARE_FORMAT = (os.getenv("SIZE_AWARE_FORMAT", "1").strip() != "0")
+# Spec used to download the chosen formats once an entry's list is narrowed to them
+PLANNED_FORMAT = "bv*+ba/b"
 
 VIDEO_EXTENSIONS = {".mp4", ".mkv", ".webm", ".mov"}
 AUDIO_EXTENSIONS = {".aac", ".flac", ".m4a", ".mka", ".mp3", ".oga", ".ogg", ".opus", ".wav", ".weba"}
@@ -106,6 +192,25 @@ IOS_TRANSCODE_CRF = max(18, int(os.getenv("IOS_TRANSCODE_CRF", "28")))
 IOS_TRANSCODE_MAX_HEIGHT = max(240, int(os.getenv("IOS_TRANSCODE_MAX_HEIGHT", "720")))
 IOS_TRANSCODE_MAX_WIDTH = max(240, int(os.getenv("IOS_TRANSCODE_MAX_WIDTH", "1280")))
 IOS_TRANSCODE_MAX_FPS = max(1, int(os.getenv("IOS_TRANSCODE_MAX_FPS", "30")))
+# Size-targeted transcodes: the bitrate is derived from duration and MAX_SIZE_MB (CRF capped by VBV),
+# and the resolution steps down until each pixel still gets TRANSCODE_MIN_BPP bits
+TRANSCODE_TARGET_SIZE = (os.getenv("TRANSCODE_TARGET_SIZE", "1").strip() != "0")
+TRANSCODE_MIN_BPP = max(0.01, float(os.getenv("TRANSCODE_MIN_BPP", "0.06")))
+TRANSCODE_MIN_VIDEO_KBPS = max(50, int(os.getenv("TRANSCODE_MIN_VIDEO_KBPS", "150")))
+# Heights tried (largest first, capped by IOS_TRANSCODE_MAX_HEIGHT) when the bitrate budget is tight
+TRANSCODE_HEIGHT_LADDER = (1080, 720, 540, 480, 360, 240)
+FFPROBE_MAX_PARALLEL = max(1, int(os.getenv("FFPROBE_MAX_PARALLEL", "4")))
+# Transcode service: ffmpeg jobs get their own queue; worker count and per-job -threads
+# default to a split of the available cores. IOS_TRANSCODE_MAX_PARALLEL caps heavy-lane jobs
+CPU_COUNT = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else (os.cpu_count() or 1)
+TRANSCODE_WORKERS = max(1, int(os.getenv("TRANSCODE_WORKERS", str(max(1, CPU_COUNT // 2)))))
+TRANSCODE_THREADS = max(1, int(os.getenv("TRANSCODE_THREADS", str(max(1, CPU_COUNT // TRANSCODE_WORKERS)))))
+TRANSCODE_TIMEOUT_SECONDS = max(10, int(os.getenv("TRANSCODE_TIMEOUT_SECONDS", "600")))
+# Items of one link (carousel, playlist) are normalized concurrently, at most this many at once;
+# the transcodes themselves still queue for TRANSCODE_WORKERS
+ITEM_PROCESS_MAX_PARALLEL = max(
+    1, int(os.getenv("ITEM_PROCESS_MAX_PARALLEL", str(TRANSCODE_WORKERS)))
+)
 
 # Cookie fallback lists (comma / semicolon / newline separated)
 COOKIES_FILES = os.getenv("COOKIES_FILES") or os.getenv("COOKIES_FILE")
@@ -114,16 +219,105 @@ YT_COOKIES_FILES = os.getenv("YT_COOKIES_FILES") or os.getenv("YT_COOKIES_FILE")
 TT_COOKIES_FILES = os.getenv("TT_COOKIES_FILES") or os.getenv("TT_COOKIES_FILE")
 VK_COOKIES_FILES = os.getenv("VK_COOKIES_FILES") or os.getenv("VK_COOKIES_FILE")
 
-# Semaphore to limit parallel downloads
-sema = asyncio.Semaphore(MAX_CONCURRENT_DOWNLOADS)
-ios_transcode_sema = threading.Semaphore(IOS_TRANSCODE_MAX_PARALLEL)
+# Extraction results per canonical URL: successful ones are reused for a short while (format
+# URLs expire), permanent failures and limit rejections are answered without any network request
+METADATA_CACHE_TTL_SECONDS = int(os.getenv("METADATA_CACHE_TTL_SECONDS", "600"))
+METADATA_CACHE_MAX_ENTRIES = max(1, int(os.getenv("METADATA_CACHE_MAX_ENTRIES", "256")))
+NEGATIVE_CACHE_TTL_SECONDS = int(os.getenv("NEGATIVE_CACHE_TTL_SECONDS", "1800"))
+# Instagram story trays (all current stories of a user) are extracted once per user for this long
+# and shared by every /stories/<user>/<id> link; 0 = extract per link
+IG_STORY_TRAY_TTL_SECONDS = int(os.getenv("IG_STORY_TRAY_TTL_SECONDS", "120"))
+# A link waits this long for another link's tray extraction (slow retries or a stuck cookie)
+# before it extracts with its own cookie
+IG_STORY_TRAY_WAIT_SECONDS = max(1.0, float(os.getenv("IG_STORY_TRAY_WAIT_SECONDS", "60")))
+
+# Hedged attempts: if extraction with one cookie takes longer than HEDGE_DELAY_SECONDS,
+# the next cookie is tried in parallel (at most HEDGE_MAX_PARALLEL attempts at once)
+HEDGE_ENABLED = (os.getenv("HEDGE_ENABLED", "0").strip() != "0")
+HEDGE_DELAY_SECONDS = max(0.5, float(os.getenv("HEDGE_DELAY_SECONDS", "8")))
+HEDGE_MAX_PARALLEL = max(2, int(os.getenv("HEDGE_MAX_PARALLEL", "2")))
+
+# Cookie health: attempts are ordered by recent success rate; a cookie failing
+# COOKIE_BREAKER_FAILURES times in a row is skipped for a cooldown that doubles
+# on every failed half-open retry (up to COOKIE_BREAKER_MAX_COOLDOWN_SECONDS)
+COOKIE_HEALTH_DECAY = min(0.95, max(0.05, float(os.getenv("COOKIE_HEALTH_DECAY", "0.3"))))
+COOKIE_BREAKER_FAILURES = max(1, int(os.getenv("COOKIE_BREAKER_FAILURES", "3")))
+COOKIE_BREAKER_COOLDOWN_SECONDS = max(1, int(os.getenv("COOKIE_BREAKER_COOLDOWN_SECONDS", "600")))
+COOKIE_BREAKER_MAX_COOLDOWN_SECONDS = max(
+    COOKIE_BREAKER_COOLDOWN_SECONDS, int(os.getenv("COOKIE_BREAKER_MAX_COOLDOWN_SECONDS", str(6 * 3600)))
+)
+# Request budget per cookie account (0 disables); load is spread over healthy accounts,
+# least recently used first, and accounts over budget are used only when nothing else is left
+COOKIE_REQUESTS_PER_MINUTE = float(os.getenv("COOKIE_REQUESTS_PER_MINUTE", "4"))
+COOKIE_REQUESTS_BURST = max(1, int(os.getenv("COOKIE_REQUESTS_BURST", "3")))
+COOKIE_HEALTHY_SUCCESS_RATE = 0.5
+
+# Limits concurrent ffprobe subprocesses (they run on the event loop, not in worker threads)
+_probe_sema = asyncio.Semaphore(FFPROBE_MAX_PARALLEL)
+
+# Known chat ids (loaded once from USERS_FILE) and new ones not yet appended to it
+_known_users: set[str] = set()
+_pending_users: list[str] = []
 
 # Per-URL locks to avoid duplicate downloads
 _cache_locks: dict[str, asyncio.Lock] = {}
+# Holders and waiters of the locks taken through _keyed_lock (dropped with the last one)
+_cache_lock_users: Counter[str] = Counter()
 
-# In-memory cache index (also persisted in meta.json)
+# In-memory cache index (persisted in the SQLite cache DB).
+# Alias URL keys point to the same entry dict as the entry's own key.
 _cache_index: dict[str, dict[str, Any]] = {}
 
+# Media identity ("<extractor_key>:<id>") -> cache key of the entry holding it
+_media_alias_index: dict[str, str] = {}
+
+# Expiry scheduling: min-heap of (deadline, key) plus the live deadline per key;
+# heap items whose deadline no longer matches are stale and skipped when popped
+_cache_expiry_heap: list[tuple[float, str]] = []
+_cache_expiry_deadlines: dict[str, float] = {}
+
+# Entries dropped from the index whose files and rows clean_cache_job still has to delete
+_cache_pending_purges: list[dict[str, Any]] = []
+
+# Bytes of local files per cache key (entries whose files are not evicted) and their sum
+_cache_entry_bytes: dict[str, int] = {}
+_cache_total_bytes = 0
+
+# Keys of entries whose local files are being uploaded (count of sends); expiry and
+# eviction leave them alone until the upload is done
+_cache_pins: Counter[str] = Counter()
+
+# Keys whose entries changed (new entries, hits, file_ids, aliases); flushed to the DB by clean_cache_job
+_cache_dirty_keys: set[str] = set()
+
+# SQLite cache DB (lazily opened, shared between the event loop and worker threads)
+_cache_db_conn: sqlite3.Connection | None = None
+_cache_db_lock = threading.Lock()
+
+# Cookie health per (site, cookie file; "" = no cookies) and keys not yet saved to the DB
+_cookie_health: dict[tuple[str, str], "CookieHealth"] = {}
+_cookie_health_dirty: set[tuple[str, str]] = set()
+
+# Cookie accounts: request budget and last use (monotonic) per cookie file
+_cookie_budgets: dict[str, "TokenBucket"] = {}
+_cookie_last_used: dict[str, float] = {}
+
+# Parsed cookie lists: cache id -> (mtimes of the directories involved, files)
+_cookie_list_cache: dict[str, tuple[tuple[int, ...], list[str]]] = {}
+
+# Extraction memo: cache key -> (expires_at, cookie file used, extracted dict)
+_metadata_cache: dict[str, tuple[float, str | None, dict[str, Any]]] = {}
+# Known failures: cache key -> (expires_at, category, message)
+_negative_cache: dict[str, tuple[float, str, str]] = {}
+# Story trays: username -> (expires_at, sanitized tray info); tray extractions in flight per username.
+# Used from extract stage threads, hence the lock
+_story_tray_cache: dict[str, tuple[float, dict[str, Any]]] = {}
+_story_tray_inflight: dict[str, Future] = {}
+_story_tray_lock = threading.Lock()
+
+# Memoized short link redirects: short url -> (expires_at, resolved url). Event loop only
+_short_link_cache: dict[str, tuple[float, str]] = {}
+
 # -------------------------
 # URL patterns (keep strict behaviour: react only to supported domains)
 # -------------------------
@@ -138,6 +332,475 @@ YANDEX_URL_RE = re.compile(r"https?://(?:(?:www|m)\.)?music\.yandex\.(?:ru|by|kz
 # Simple music query: "Artist - Title" (existing behavior)
 MUSIC_PATTERN = re.compile(r"^(\w{2,}(\s+\w{2,}){0,3})\s+-\s+(\w{2,}(\s+\w{2,}){0,3})$")
 
+# Query parameters that only track the share and never change the media
+TRACKING_QUERY_PARAMS = {
+    "si", "feature", "pp",  # YouTube
+    "igsh", "igshid", "img_index",  # Instagram
+    "_r", "_t", "is_from_webapp", "sender_device", "sender_web_id", "web_id",
+    "u_code", "user_id", "sec_uid", "timestamp", "tt_from", "checksum",  # TikTok
+    "fbclid", "gclid", "yclid", "ref", "refsrc", "source", "from",
+}
+TRACKING_QUERY_PREFIXES = ("utm_", "share_")
+
+YOUTUBE_VIDEO_ID_RE = re.compile(r"^[A-Za-z0-9_-]{11}$")
+VK_VIDEO_ID_RE = re.compile(r"(?:video|clip)(-?\d+_\d+)")
+VK_WALL_ID_RE = re.compile(r"wall(-?\d+_\d+)")
+
+
+# -------------------------
+# Pipeline stages
+# -------------------------
+
+# Lane of the job running in the current task ("fast" or "heavy"); set on lane admission
+_current_lane: contextvars.ContextVar[str] = contextvars.ContextVar("current_lane", default="fast")
+
+
+class PipelineStage:
+    """Bounded stage of the media pipeline.
+
+    Jobs wait for a free slot in an asyncio queue (the semaphore) instead of occupying
+    threads, and blocking work runs on the stage's own executor, never on the shared
+    asyncio.to_thread pool. Heavy-lane jobs may not take the last worker, so short
+    media always finds a free one.
+    """
+
+    def __init__(self, name: str, workers: int) -> None:
+        self.name = name
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"{name}-stage")
+        self._slots = asyncio.Semaphore(workers)
+        self._heavy_slots = asyncio.Semaphore(max(1, workers - 1))
+        self.waiting = 0
+        self.active = 0
+
+    @contextlib.asynccontextmanager
+    async def slot(self):
+        async with contextlib.AsyncExitStack() as stack:
+            self.waiting += 1
+            try:
+                if _current_lane.get() == "heavy":
+                    await stack.enter_async_context(self._heavy_slots)
+                await stack.enter_async_context(self._slots)
+            finally:
+                self.waiting -= 1
+            self.active += 1
+            try:
+                yield
+            finally:
+                self.active -= 1
+
+    async def run(self, fn, *args, **kwargs):
+        """Run blocking fn(*args, **kwargs) on this stage's executor once a slot is free."""
+        async with self.slot():
+            loop = asyncio.get_running_loop()
+            ctx = contextvars.copy_context()
+            return await loop.run_in_executor(self.executor, functools.partial(ctx.run, fn, *args, **kwargs))
+
+
+EXTRACT_STAGE = PipelineStage("extract", PIPELINE_EXTRACT_WORKERS)
+DOWNLOAD_STAGE = PipelineStage("download", PIPELINE_DOWNLOAD_WORKERS)
+PROCESS_STAGE = PipelineStage("process", PIPELINE_PROCESS_WORKERS)
+UPLOAD_STAGE = PipelineStage("upload", PIPELINE_UPLOAD_WORKERS)
+
+
+# -------------------------
+# Transcoding
+# -------------------------
+
+class TranscodeService:
+    """Runs ffmpeg jobs as asyncio subprocesses behind its own bounded queue.
+
+    No thread waits for a slot or for ffmpeg. At most `workers` jobs run at once, each
+    with `-threads threads`; heavy-lane jobs may take at most `heavy_workers` of them.
+    A job is killed when it exceeds `timeout` or when the awaiting task is cancelled.
+    """
+
+    def __init__(self, workers: int, threads: int, heavy_workers: int, timeout: float) -> None:
+        self.workers = workers
+        self.threads = threads
+        self.timeout = timeout
+        self._slots = asyncio.Semaphore(workers)
+        self._heavy_slots = asyncio.Semaphore(heavy_workers)
+        self.queued = 0
+        self.running = 0
+        self.done = 0
+        self.failed = 0
+        self.cpu_seconds = 0.0
+
+    async def run(self, cmd: list[str], *, label: str, heavy: bool = False) -> None:
+        """Run ffmpeg cmd (cmd[0] is the ffmpeg binary); raises RuntimeError on failure or timeout."""
+        async with contextlib.AsyncExitStack() as stack:
+            self.queued += 1
+            try:
+                if self._slots.locked() or (heavy and self._heavy_slots.locked()):
+                    logger.info(f"Перекодировка {label} ждёт слот (в очереди {self.queued}, выполняется {self.running})")
+                if heavy:
+                    await stack.enter_async_context(self._heavy_slots)
+                await stack.enter_async_context(self._slots)
+            finally:
+                self.queued -= 1
+            self.running += 1
+            try:
+                await self._run_ffmpeg(cmd, label)
+            finally:
+                self.running -= 1
+
+    async def _run_ffmpeg(self, cmd: list[str], label: str) -> None:
+        started = time.monotonic()
+        # -benchmark makes ffmpeg report its own CPU time ("bench: utime=... stime=...")
+        proc = await asyncio.create_subprocess_exec(
+            cmd[0],
+            "-nostdin",
+            "-hide_banner",
+            "-nostats",
+            "-benchmark",
+            *cmd[1:],
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        try:
+            _, stderr = await asyncio.wait_for(proc.communicate(), timeout=self.timeout)
+        except BaseException as e:
+            with contextlib.suppress(ProcessLookupError):
+                proc.kill()
+            await proc.wait()
+            self.failed += 1
+            if isinstance(e, asyncio.TimeoutError):
+                raise RuntimeError(f"ffmpeg не уложился в {int(self.timeout)} с") from None
+            logger.info(f"Перекодировка {label} отменена")
+            raise
+
+        text = stderr.decode(errors="replace")
+        if proc.returncode != 0:
+            self.failed += 1
+            raise RuntimeError(text.strip()[-2000:] or f"ffmpeg завершился с кодом {proc.returncode}")
+
+        cpu = 0.0
+        bench = re.search(r"bench: utime=([\d.]+)s stime=([\d.]+)s", text)
+        if bench:
+            cpu = float(bench.group(1)) + float(bench.group(2))
+        self.done += 1
+        self.cpu_seconds += cpu
+        logger.info(
+            f"Перекодировка {label}: {time.monotonic() - started:.1f} с, CPU {cpu:.1f} с "
+            f"(в очереди {self.queued}, выполняется {self.running})"
+        )
+
+
+TRANSCODER = TranscodeService(
+    TRANSCODE_WORKERS,
+    TRANSCODE_THREADS,
+    # short clips always find a free worker when there is more than one
+    max(1, min(IOS_TRANSCODE_MAX_PARALLEL, TRANSCODE_WORKERS - 1)),
+    TRANSCODE_TIMEOUT_SECONDS,
+)
+
+
+# -------------------------
+# Fair scheduling & quotas
+# -------------------------
+
+class QueueFullError(Exception):
+    """The chat already has too many jobs waiting."""
+
+
+class TokenBucket:
+    def __init__(self, rate_per_second: float, burst: int) -> None:
+        self.rate = rate_per_second
+        self.capacity = float(burst)
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_take(self) -> bool:
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def refund(self) -> None:
+        self.tokens = min(self.capacity, self.tokens + 1)
+
+    def retry_after(self) -> float:
+        """Seconds until the next token is available."""
+        self._refill()
+        if self.tokens >= 1 or self.rate <= 0:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def is_full(self) -> bool:
+        self._refill()
+        return self.tokens >= self.capacity
+
+
+class QuotaRegistry:
+    """Token bucket per id (user or chat). rate_per_minute <= 0 disables the quota."""
+
+    def __init__(self, rate_per_minute: float, burst: int) -> None:
+        self.rate_per_minute = rate_per_minute
+        self.burst = burst
+        self._buckets: dict[int, TokenBucket] = {}
+
+    def _bucket(self, key: int) -> TokenBucket:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(self.rate_per_minute / 60.0, self.burst)
+            self._buckets[key] = bucket
+        return bucket
+
+    def try_take(self, key: int | None) -> float:
+        """Take one token. Returns 0 on success or seconds to wait."""
+        if key is None or self.rate_per_minute <= 0:
+            return 0.0
+        bucket = self._bucket(key)
+        if bucket.try_take():
+            return 0.0
+        return max(1.0, bucket.retry_after())
+
+    def refund(self, key: int | None) -> None:
+        if key is not None and key in self._buckets:
+            self._buckets[key].refund()
+
+    def prune(self) -> None:
+        """Forget idle buckets (a full bucket is the same as a new one)."""
+        for key in [k for k, b in self._buckets.items() if b.is_full()]:
+            del self._buckets[key]
+
+
+class FairScheduler:
+    """Admits jobs to a fixed number of slots, round-robin between chats.
+
+    Each chat has its own FIFO of waiters; when a slot frees up, the next chat in the
+    rotation gets it, so one chat pasting 20 links cannot starve the others.
+    """
+
+    def __init__(self, name: str, capacity: int, max_queued_per_chat: int) -> None:
+        self.name = name
+        self.capacity = capacity
+        self.max_queued_per_chat = max_queued_per_chat
+        self.active = 0
+        self._queues: dict[int, deque[asyncio.Future]] = {}
+        self._rotation: deque[int] = deque()
+
+    @property
+    def queued(self) -> int:
+        return sum(len(q) for q in self._queues.values())
+
+    def position(self, chat_id: int, waiter: asyncio.Future) -> int:
+        """1-based estimate of when waiter gets a slot under round-robin."""
+        queue = self._queues.get(chat_id)
+        if queue is None or waiter not in queue:
+            return 0
+        index = queue.index(waiter)
+        ahead = sum(min(len(q), index + 1) for c, q in self._queues.items() if c != chat_id)
+        return ahead + index + 1
+
+    @contextlib.asynccontextmanager
+    async def slot(self, chat_id: int, on_queued=None):
+        """Hold one slot. on_queued(position) is awaited if the job has to wait."""
+        if self.active < self.capacity and not self._rotation:
+            self.active += 1
+        else:
+            queue = self._queues.get(chat_id)
+            if queue is not None and len(queue) >= self.max_queued_per_chat:
+                raise QueueFullError(f"{self.name}: в очереди чата уже {len(queue)} задач")
+            if queue is None:
+                queue = self._queues[chat_id] = deque()
+                self._rotation.append(chat_id)
+            waiter = asyncio.get_running_loop().create_future()
+            queue.append(waiter)
+            try:
+                if on_queued is not None:
+                    await on_queued(self.position(chat_id, waiter))
+                await waiter
+            except asyncio.CancelledError:
+                if waiter.done() and not waiter.cancelled():
+                    # the slot was granted right before cancellation
+                    self._release()
+                else:
+                    self._forget(chat_id, waiter)
+                raise
+        try:
+            yield
+        finally:
+            self._release()
+
+    def _forget(self, chat_id: int, waiter: asyncio.Future) -> None:
+        queue = self._queues.get(chat_id)
+        if queue is None:
+            return
+        try:
+            queue.remove(waiter)
+        except ValueError:
+            pass
+        if not queue:
+            del self._queues[chat_id]
+            try:
+                self._rotation.remove(chat_id)
+            except ValueError:
+                pass
+
+    def _release(self) -> None:
+        self.active -= 1
+        while self.active < self.capacity and self._rotation:
+            chat_id = self._rotation.popleft()
+            queue = self._queues[chat_id]
+            waiter = queue.popleft()
+            if queue:
+                self._rotation.append(chat_id)
+            else:
+                del self._queues[chat_id]
+            if waiter.done():
+                continue
+            self.active += 1
+            waiter.set_result(None)
+
+
+# Turns at extraction (the slowest, cookie-spending step), round-robin between chats; the
+# fast/heavy lane is chosen once extraction tells how big the media is
+EXTRACT_ADMISSION = FairScheduler("extract", PIPELINE_EXTRACT_WORKERS, SCHEDULER_MAX_QUEUED_PER_CHAT)
+FAST_LANE = FairScheduler("fast", FAST_LANE_SLOTS, SCHEDULER_MAX_QUEUED_PER_CHAT)
+HEAVY_LANE = FairScheduler("heavy", HEAVY_LANE_SLOTS, SCHEDULER_MAX_QUEUED_PER_CHAT)
+USER_QUOTAS = QuotaRegistry(USER_QUOTA_PER_MINUTE, USER_QUOTA_BURST)
+CHAT_QUOTAS = QuotaRegistry(CHAT_QUOTA_PER_MINUTE, CHAT_QUOTA_BURST)
+
+
+def _refund_request_quota(chat_id: int, requester_id: int | None) -> None:
+    """Give back the request charged by _take_request_quota (the job was never admitted)."""
+    USER_QUOTAS.refund(requester_id)
+    CHAT_QUOTAS.refund(chat_id)
+
+
+def _take_request_quota(chat_id: int, requester_id: int | None) -> float:
+    """Charge one request to the user and the chat. Returns 0 or seconds until allowed."""
+    wait = USER_QUOTAS.try_take(requester_id)
+    if wait:
+        return wait
+    wait = CHAT_QUOTAS.try_take(chat_id)
+    if wait:
+        USER_QUOTAS.refund(requester_id)
+    return wait
+
+
+# -------------------------
+# Download error taxonomy
+# -------------------------
+
+# What the cookie fallback loop does with each category:
+#   permanent    - removed / not found / geo-blocked at extraction: no cookie helps, stop
+#   policy       - over our duration/size limits: stop, the message goes to the user
+#   auth         - login required / forbidden: next cookie, counts against the cookie
+#   rate_limited - next cookie; the account's budget is drained so others take the load
+#   transient    - network trouble (yt-dlp already retried): next cookie, cookie not blamed
+#   unknown      - anything else: next cookie
+STOP_ERROR_CATEGORIES = {"permanent", "policy"}
+
+_HTTP_STATUS_CATEGORIES = {401: "auth", 403: "auth", 404: "permanent", 410: "permanent", 429: "rate_limited"}
+_ERROR_MESSAGE_CATEGORIES = [
+    ("auth", re.compile(
+        r"login required|\blog in\b|sign in|logged-in|cookies|authenticat|private|checkpoint|"
+        r"age-restricted|confirm your age|members-only", re.I,
+    )),
+    ("rate_limited", re.compile(r"rate.?limit|too many requests|try again later|please wait a few minutes", re.I)),
+    ("permanent", re.compile(
+        r"not found|does not exist|has been removed|been deleted|no longer available|video unavailable|"
+        r"unsupported url|available in your country|geo.?restrict|blocked it in your country|"
+        r"(?:video|post|media|content) is not available|"
+        r"copyright|account has been terminated|there is no video", re.I,
+    )),
+    ("transient", re.compile(
+        r"timed out|timeout|connection (?:reset|refused|aborted)|temporary failure|temporarily unavailable|"
+        r"network is unreachable|name resolution|remote end closed|eof occurred|incompleteread", re.I,
+    )),
+]
+
+# Depend on the format spec or on what the cookie/client is shown, not on the post itself
+_FORMAT_SELECTION_ERROR_RE = re.compile(r"requested format is not available|no video formats found", re.I)
+# yt-dlp's wording for failures after extraction (media/fragment URLs, usually expired CDN links)
+_DOWNLOAD_PHASE_ERROR_RE = re.compile(r"unable to download (?:video data|fragment)|fragment \d+ not found", re.I)
+
+# Failed attempts per (site, category), for /cookies
+_download_error_counts: Counter[tuple[str, str]] = Counter()
+
+
+class MediaPolicyError(ValueError):
+    """The media breaks our limits (duration, size); the message is shown to the user."""
+
+
+class DownloadFailure(RuntimeError):
+    """A download attempt failed; category tells the fallback loop what to do next."""
+
+    def __init__(self, message: str, category: str) -> None:
+        super().__init__(message)
+        self.category = category
+
+
+def _http_status(exc: BaseException) -> int | None:
+    """HTTP status of a yt-dlp / requests error, if any.
+
+    The error's own message wins; otherwise only explicit causes (exc_info, cause,
+    `raise ... from`) are followed. Implicit __context__ may be an unrelated HTTP error
+    that yt-dlp caught and handled along the way.
+    """
+    status = re.search(r"HTTP Error (\d{3})", str(exc))
+    if status:
+        return int(status.group(1))
+    seen: set[int] = set()
+    pending: list[Any] = [exc]
+    while pending:
+        err = pending.pop()
+        if err is None or id(err) in seen:
+            continue
+        seen.add(id(err))
+        for attr in ("status", "code", "status_code"):
+            value = getattr(err, attr, None)
+            if isinstance(value, int) and 100 <= value < 600:
+                return value
+        response = getattr(err, "response", None)
+        value = getattr(response, "status_code", None) or getattr(response, "status", None)
+        if isinstance(value, int):
+            return value
+        exc_info = getattr(err, "exc_info", None)
+        if isinstance(exc_info, tuple) and len(exc_info) > 1:
+            pending.append(exc_info[1])
+        pending.extend([getattr(err, "cause", None), err.__cause__])
+    return None
+
+
+def classify_download_error(exc: BaseException, *, downloading: bool = False) -> str:
+    """Category of a failed attempt; downloading: the error came after extraction succeeded."""
+    if isinstance(exc, DownloadFailure):
+        return exc.category
+    if isinstance(exc, MediaPolicyError):
+        return "policy"
+    text = str(exc)
+    if _FORMAT_SELECTION_ERROR_RE.search(text):
+        return "unknown"
+    category = _classify_by_status_or_message(exc, text)
+    if category == "permanent" and (downloading or _DOWNLOAD_PHASE_ERROR_RE.search(text)):
+        # the post was extracted fine: a 404 here is a stale media URL, not a removed post
+        return "unknown"
+    return category
+
+
+def _classify_by_status_or_message(exc: BaseException, text: str) -> str:
+    status = _http_status(exc)
+    if status in _HTTP_STATUS_CATEGORIES:
+        return _HTTP_STATUS_CATEGORIES[status]
+    if status is not None and status >= 500:
+        return "transient"
+    if isinstance(exc, (TimeoutError, ConnectionError, requests.ConnectionError, requests.Timeout)):
+        return "transient"
+    for category, pattern in _ERROR_MESSAGE_CATEGORIES:
+        if pattern.search(text):
+            return category
+    return "unknown"
+
 
 # -------------------------
 # Helpers
@@ -146,7 +809,10 @@ MUSIC_PATTERN = re.compile(r"^(\w{2,}(\s+\w{2,}){0,3})\s+-\s+(\w{2,}(\s+\w{2,}){
 def _ensure_dirs() -> None:
     DATA_DIR.mkdir(parents=True, exist_ok=True)
     CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    WORK_DIR.mkdir(parents=True, exist_ok=True)
     IG_USER_COOKIES_DIR.mkdir(parents=True, exist_ok=True)
+    if TRANSCODE_CACHE_ENABLED:
+        TRANSCODE_CACHE_DIR.mkdir(parents=True, exist_ok=True)
 
 
 def auto_update_ytdlp() -> None:
@@ -167,31 +833,82 @@ def auto_update_ytdlp() -> None:
         logger.warning(f"Не удалось обновить yt-dlp автоматически: {e}")
 
 
-def save_user(chat_id: int) -> None:
-    """Сохраняет chat_id пользователя в файл, если его ещё нет."""
+def _load_users() -> None:
+    """Загружает известные chat_id из файла один раз при старте."""
     try:
-        _ensure_dirs()
-        if not USERS_FILE.exists():
-            USERS_FILE.write_text("", encoding="utf-8")
+        if USERS_FILE.exists():
+            _known_users.update(
+                line.strip() for line in USERS_FILE.read_text(encoding="utf-8").splitlines() if line.strip()
+            )
+    except Exception as e:
+        logger.error(f"Ошибка загрузки пользователей: {e}")
+
 
-        users = set(USERS_FILE.read_text(encoding="utf-8").splitlines())
-        if str(chat_id) not in users:
-            with USERS_FILE.open("a", encoding="utf-8") as f:
-                f.write(f"{chat_id}\n")
+def save_user(chat_id: int) -> None:
+    """Запоминает chat_id пользователя; в файл он попадёт при следующем flush_users_job."""
+    user = str(chat_id)
+    if user not in _known_users:
+        _known_users.add(user)
+        _pending_users.append(user)
+
+
+def _append_users(users: list[str]) -> None:
+    _ensure_dirs()
+    with USERS_FILE.open("a", encoding="utf-8") as f:
+        f.write("".join(f"{user}\n" for user in users))
+
+
+async def _flush_pending_users() -> None:
+    """Дописывает накопленных пользователей в файл; с файлом работает вне event loop."""
+    # the batch is taken on the loop, so save_user never races with it
+    batch = _pending_users[:]
+    _pending_users.clear()
+    if not batch:
+        return
+    try:
+        await asyncio.to_thread(_append_users, batch)
     except Exception as e:
-        logger.error(f"Ошибка сохранения пользователя: {e}")
+        logger.error(f"Ошибка сохранения пользователей: {e}")
+        _pending_users[:0] = batch
+
+
+async def flush_users_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    await _flush_pending_users()
+
+
+async def _on_shutdown(application: Application) -> None:
+    await _flush_pending_users()
+    _save_cookie_health(_pop_dirty_cookie_health())
+    _apply_cache_expiry(_snapshot_cache_expiry(_pop_dirty_cache_entries()))
+
+
+def _dir_mtimes(dirs: Iterable[Path]) -> tuple[int, ...]:
+    """Modification times of dirs; adding, removing or replacing a file changes them."""
+    mtimes: list[int] = []
+    for d in dirs:
+        try:
+            mtimes.append(d.stat().st_mtime_ns)
+        except OSError:
+            mtimes.append(-1)
+    return tuple(mtimes)
+
+
+@functools.lru_cache(maxsize=64)
+def _split_cookie_list(value: str) -> tuple[str, ...]:
+    # allow comma / semicolon / newline separated lists
+    return tuple(chunk.strip() for chunk in re.split(r"[\n,;]+", value) if chunk.strip())
 
 
 def _parse_cookie_files(value: str | None) -> list[str]:
     if not value:
         return []
-    # allow comma / semicolon / newline separated lists
-    parts: list[str] = []
-    for chunk in re.split(r"[\n,;]+", value):
-        chunk = chunk.strip()
-        if not chunk:
-            continue
-        parts.append(chunk)
+    parts = _split_cookie_list(value)
+
+    # existence is re-checked only when one of the parent directories changes
+    signature = _dir_mtimes(sorted({Path(p).parent for p in parts}))
+    cached = _cookie_list_cache.get(value)
+    if cached and cached[0] == signature:
+        return list(cached[1])
 
     # keep only existing files
     existing: list[str] = []
@@ -200,7 +917,8 @@ def _parse_cookie_files(value: str | None) -> list[str]:
             existing.append(p)
         else:
             logger.warning(f"Файл cookies не найден и будет пропущен: {p}")
-    return existing
+    _cookie_list_cache[value] = (signature, existing)
+    return list(existing)
 
 
 def _uploaded_ig_cookie_path_for_user(user_id: int) -> Path:
@@ -208,22 +926,20 @@ def _uploaded_ig_cookie_path_for_user(user_id: int) -> Path:
 
 
 def _list_uploaded_ig_cookie_files(preferred_user_id: int | None = None) -> list[str]:
-    _ensure_dirs()
-
-    preferred_path = _uploaded_ig_cookie_path_for_user(preferred_user_id) if preferred_user_id else None
-    ordered_paths: list[Path] = []
-
-    if preferred_path and preferred_path.exists():
-        ordered_paths.append(preferred_path)
-
-    for path in sorted(IG_USER_COOKIES_DIR.glob("user_*.txt")):
-        if not path.is_file():
-            continue
-        if preferred_path and path == preferred_path:
-            continue
-        ordered_paths.append(path)
+    signature = _dir_mtimes([IG_USER_COOKIES_DIR])
+    cached = _cookie_list_cache.get("ig_user_cookies")
+    if cached and cached[0] == signature:
+        pool = cached[1]
+    else:
+        _ensure_dirs()
+        signature = _dir_mtimes([IG_USER_COOKIES_DIR])
+        pool = [str(path) for path in sorted(IG_USER_COOKIES_DIR.glob("user_*.txt")) if path.is_file()]
+        _cookie_list_cache["ig_user_cookies"] = (signature, pool)
 
-    return [str(path) for path in ordered_paths]
+    preferred_path = str(_uploaded_ig_cookie_path_for_user(preferred_user_id)) if preferred_user_id else None
+    if preferred_path not in pool:
+        return list(pool)
+    return [preferred_path] + [path for path in pool if path != preferred_path]
 
 
 def _validate_instagram_cookie_text(cookie_text: str) -> tuple[bool, str | None]:
@@ -295,95 +1011,754 @@ def _cookie_files_for_site(site: str, preferred_user_id: int | None = None) -> l
     return out
 
 
+@dataclass
+class CookieHealth:
+    """Success statistics and circuit breaker state of one cookie file on one site."""
+
+    success_rate: float = 1.0  # optimistic, so new cookies get tried
+    latency: float = 0.0  # seconds until extraction finished, moving average
+    successes: int = 0
+    failures: int = 0
+    consecutive_failures: int = 0
+    open_until: float = 0.0
+    cooldown: float = 0.0
+    last_error: str = ""
+    last_used_at: float = 0.0
+    probing: bool = False  # a half-open retry is in flight; not persisted
+
+    def is_open(self, now: float) -> bool:
+        return self.open_until > now or (self.open_until > 0 and self.probing)
+
+    def state(self, now: float) -> str:
+        if self.open_until <= 0:
+            return "ok"
+        return "open" if self.is_open(now) else "half-open"
+
+    def to_json(self) -> str:
+        data = {k: v for k, v in self.__dict__.items() if k != "probing"}
+        return json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+
+
+def _cookie_health_for(site: str, cookiefile: str | None) -> CookieHealth:
+    key = (site, cookiefile or "")
+    health = _cookie_health.get(key)
+    if health is None:
+        health = CookieHealth()
+        _cookie_health[key] = health
+    return health
+
+
+def _cookie_budget(cookiefile: str) -> TokenBucket | None:
+    if COOKIE_REQUESTS_PER_MINUTE <= 0:
+        return None
+    bucket = _cookie_budgets.get(cookiefile)
+    if bucket is None:
+        bucket = TokenBucket(COOKIE_REQUESTS_PER_MINUTE / 60.0, COOKIE_REQUESTS_BURST)
+        _cookie_budgets[cookiefile] = bucket
+    return bucket
+
+
+def _cookie_has_budget(cookiefile: str | None) -> bool:
+    bucket = _cookie_budget(cookiefile) if cookiefile else None
+    return bucket is None or bucket.retry_after() <= 0
+
+
+def _drain_cookie_budget(cookiefile: str | None) -> None:
+    """Back off a rate-limited account: it goes behind the others until its budget refills."""
+    bucket = _cookie_budget(cookiefile) if cookiefile else None
+    if bucket is not None:
+        bucket.tokens = 0.0
+
+
+def _use_cookie_account(cookiefile: str | None) -> None:
+    """Charge an attempt to the account's budget right before it is made."""
+    if not cookiefile:
+        return
+    _cookie_last_used[cookiefile] = time.monotonic()
+    bucket = _cookie_budget(cookiefile)
+    if bucket is not None:
+        bucket.try_take()
+
+
+def _refund_cookie_account(cookiefile: str | None) -> None:
+    """Give back the budget charged for an attempt that made no request with the account."""
+    bucket = _cookie_budget(cookiefile) if cookiefile else None
+    if bucket is not None:
+        bucket.refund()
+
+
+def _order_cookie_attempts(
+    site: str,
+    attempts: list[str | None],
+    preferred: str | None = None,
+) -> list[str | None]:
+    """Order attempts so load spreads over healthy accounts, skipping open breakers.
+
+    Healthy accounts with budget left come first, least recently used first (the
+    no-cookies attempt costs no account and leads while it works); then accounts
+    over budget; then unhealthy ones by success rate. The requester's own cookie
+    (preferred) is always the first account tried: their private links should not
+    spend other people's accounts. A cookie whose cooldown has passed is half-open:
+    exactly one request retries it. If every breaker is open, all attempts are tried
+    anyway rather than failing outright.
+    """
+    now = _now()
+    ranked: list[tuple[tuple[Any, ...], str | None]] = []
+    for idx, cookiefile in enumerate(attempts):
+        health = _cookie_health_for(site, cookiefile)
+        if health.is_open(now):
+            continue
+        if health.open_until > 0:
+            health.probing = True
+        healthy = health.success_rate >= COOKIE_HEALTHY_SUCCESS_RATE
+        last_used = _cookie_last_used.get(cookiefile, 0.0) if cookiefile else -1.0
+        rank = (
+            not healthy,
+            not _cookie_has_budget(cookiefile),
+            last_used if healthy else -health.success_rate,
+            health.latency,
+            idx,
+        )
+        ranked.append((rank, cookiefile))
+    if not ranked:
+        logger.warning(f"[{site}] Все cookies отключены после ошибок, пробую их все")
+        return list(attempts)
+    ranked.sort(key=lambda item: item[0])
+    ordered = [cookiefile for _, cookiefile in ranked]
+    if preferred and preferred in ordered:
+        ordered.remove(preferred)
+        ordered.insert(1 if ordered and ordered[0] is None else 0, preferred)
+    return ordered
+
+
+def _record_cookie_result(site: str, cookiefile: str | None, *, ok: bool, latency: float = 0.0, error: str = "") -> None:
+    health = _cookie_health_for(site, cookiefile)
+    now = _now()
+    name = cookiefile or "без cookies"
+    health.last_used_at = now
+    health.success_rate += COOKIE_HEALTH_DECAY * ((1.0 if ok else 0.0) - health.success_rate)
+    was_open = health.open_until > 0
+    health.probing = False
+    if ok:
+        health.successes += 1
+        health.latency = latency if not health.latency else health.latency + COOKIE_HEALTH_DECAY * (latency - health.latency)
+        health.consecutive_failures = 0
+        health.open_until = 0.0
+        health.cooldown = 0.0
+        if was_open:
+            logger.info(f"[{site}] Cookies снова работают: {name}")
+    else:
+        health.failures += 1
+        health.consecutive_failures += 1
+        health.last_error = error[:300]
+        if was_open or health.consecutive_failures >= COOKIE_BREAKER_FAILURES:
+            cooldown = health.cooldown * 2 if was_open else 0.0
+            health.cooldown = float(min(COOKIE_BREAKER_MAX_COOLDOWN_SECONDS, max(COOKIE_BREAKER_COOLDOWN_SECONDS, cooldown)))
+            health.open_until = now + health.cooldown
+            logger.warning(f"[{site}] Cookies отключены на {int(health.cooldown)} с после ошибок: {name}")
+    _cookie_health_dirty.add((site, cookiefile or ""))
+
+
+def _reset_cookie_health(cookiefile: str) -> None:
+    """Forget the statistics of a replaced cookie file on every site."""
+    for key in [key for key in _cookie_health if key[1] == cookiefile]:
+        _cookie_health[key] = CookieHealth()
+        _cookie_health_dirty.add(key)
+
+
+def _load_cookie_health() -> None:
+    with _cache_db_lock:
+        rows = _cache_db().execute("SELECT site, cookie, data FROM cookie_health").fetchall()
+    fields = set(CookieHealth.__dataclass_fields__) - {"probing"}
+    for site, cookie, data in rows:
+        try:
+            values = {k: v for k, v in json.loads(data).items() if k in fields}
+            _cookie_health[(str(site), str(cookie))] = CookieHealth(**values)
+        except Exception:
+            continue
+
+
+def _release_cookie_probes(site: str, untried: list[str | None]) -> None:
+    """Give back half-open retries that were reserved but not attempted."""
+    for cookiefile in untried:
+        _cookie_health_for(site, cookiefile).probing = False
+
+
+def _pop_dirty_cookie_health() -> list[tuple[str, str, str]]:
+    rows = [(site, cookie, _cookie_health[(site, cookie)].to_json()) for site, cookie in _cookie_health_dirty]
+    _cookie_health_dirty.clear()
+    return rows
+
+
+def _save_cookie_health(rows: list[tuple[str, str, str]]) -> None:
+    """Persist cookie health rows. Blocking: run off the event loop."""
+    if not rows:
+        return
+    try:
+        with _cache_db_lock:
+            conn = _cache_db()
+            with conn:
+                conn.executemany(
+                    "INSERT INTO cookie_health (site, cookie, data) VALUES (?, ?, ?) "
+                    "ON CONFLICT(site, cookie) DO UPDATE SET data = excluded.data",
+                    rows,
+                )
+    except Exception as e:
+        logger.warning(f"Не удалось сохранить состояние cookies: {e}")
+
+
+def _strip_tracking_params(url: str) -> str:
+    """Drop share/tracking query params and the fragment; lowercase scheme and host."""
+    parts = urlsplit(url.strip())
+    query = [
+        (k, v)
+        for k, v in parse_qsl(parts.query, keep_blank_values=True)
+        if k.lower() not in TRACKING_QUERY_PARAMS and not k.lower().startswith(TRACKING_QUERY_PREFIXES)
+    ]
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path, urlencode(query), ""))
+
+
+def _is_short_link(url: str) -> bool:
+    parts = urlsplit(url)
+    host = parts.netloc.lower()
+    path = parts.path.lower()
+    if host in {"vt.tiktok.com", "vm.tiktok.com", "vk.cc"}:
+        return True
+    if host.endswith("tiktok.com") and path.startswith("/t/"):
+        return True
+    if host.endswith("instagram.com") and path.startswith("/share/"):
+        return True
+    return False
+
+
+def _fetch_short_link(url: str) -> str | None:
+    """Follow redirects of a short/share link to a media URL. None if it led elsewhere. Blocking."""
+    try:
+        with requests.get(
+            url,
+            headers={"User-Agent": "Mozilla/5.0"},
+            allow_redirects=True,
+            timeout=SHORT_LINK_TIMEOUT_SECONDS,
+            stream=True,
+        ) as resp:
+            final_url = resp.url
+    except Exception as e:
+        logger.warning(f"Не удалось раскрыть короткую ссылку {url}: {e}")
+        return None
+
+    # a login or checkpoint page is on a supported domain too, but it is not the media
+    if final_url and _canonical_media_id(final_url) is not None:
+        return _strip_tracking_params(final_url)
+    return None
+
+
+async def _resolve_short_link(url: str) -> str:
+    """Resolve a short/share link; results are memoized on the event loop (failures are not)."""
+    cached = _short_link_cache.get(url)
+    if cached and cached[0] > _now():
+        return cached[1]
+
+    # not an extract stage slot: those are held by yt-dlp extractions for minutes
+    resolved = await asyncio.to_thread(_fetch_short_link, url)
+    if resolved is None:
+        return url
+
+    _short_link_cache.pop(url, None)
+    while len(_short_link_cache) >= SHORT_LINK_CACHE_MAX_ENTRIES:
+        _short_link_cache.pop(next(iter(_short_link_cache)), None)
+    _short_link_cache[url] = (_now() + SHORT_LINK_CACHE_TTL_SECONDS, resolved)
+    return resolved
+
+
+def _canonical_media_id(url: str) -> tuple[str, str] | None:
+    """Map the known URL shapes of a site to (site, media_id). None if the url is not recognized."""
+    site = _site_for_url(url)
+    parts = urlsplit(url.strip())
+    host = parts.netloc.lower()
+    segments = [s for s in parts.path.split("/") if s]
+    query = dict(parse_qsl(parts.query))
+
+    if site == "youtube":
+        video_id = None
+        if host == "youtu.be" and segments:
+            video_id = segments[0]
+        elif segments[:1] == ["watch"]:
+            video_id = query.get("v")
+        elif len(segments) >= 2 and segments[0] in {"shorts", "embed", "live", "v"}:
+            video_id = segments[1]
+        if video_id and YOUTUBE_VIDEO_ID_RE.match(video_id):
+            return site, video_id
+        return None
+
+    if site == "instagram":
+        if "stories" in segments:
+            rest = segments[segments.index("stories") + 1:]
+            if len(rest) >= 2 and rest[0] == "highlights":
+                return site, f"highlight:{rest[1]}"
+            if len(rest) >= 2 and rest[1].isdigit():
+                return site, f"story:{rest[1]}"
+            # a bare /stories/<user>/ tray changes over time
+            return None
+        for i, segment in enumerate(segments[:-1]):
+            if segment in {"p", "reel", "reels", "tv"}:
+                return site, f"post:{segments[i + 1]}"
+        return None
+
+    if site == "tiktok":
+        for i, segment in enumerate(segments[:-1]):
+            if segment in {"video", "photo"} and segments[i + 1].isdigit():
+                return site, segments[i + 1]
+        return None
+
+    if site == "vk":
+        haystack = f"{parts.path}?{parts.query}"
+        m = VK_VIDEO_ID_RE.search(haystack)
+        if m:
+            return site, f"video{m.group(1)}"
+        m = VK_WALL_ID_RE.search(haystack)
+        if m:
+            return site, f"wall{m.group(1)}"
+        return None
+
+    return None
+
+
 def _cache_key(url: str) -> str:
-    return hashlib.sha256(url.strip().encode("utf-8")).hexdigest()
+    identity = _canonical_media_id(url)
+    raw = f"{identity[0]}:{identity[1]}" if identity else _strip_tracking_params(url)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def _cache_dir_for_entry(entry: dict[str, Any]) -> Path:
+    # older entries used the bare key as directory name
+    return CACHE_DIR / str(entry.get("dir") or entry["key"])
+
+
+def _now() -> float:
+    return time.time()
+
+
+def _entry_files_expired(entry: dict[str, Any]) -> bool:
+    """Local media files are past CACHE_TTL_SECONDS (or already removed)."""
+    if entry.get("files_evicted"):
+        return True
+    try:
+        return float(entry.get("expires_at", 0)) <= _now()
+    except Exception:
+        return True
+
+
+def _entry_has_all_file_ids(entry: dict[str, Any]) -> bool:
+    items = entry.get("items") or []
+    if not isinstance(items, list) or not items:
+        return False
+    return all(isinstance(it, dict) and it.get("tg_file_id") for it in items)
+
+
+def _entry_file_ids_expired(entry: dict[str, Any]) -> bool:
+    try:
+        return float(entry.get("file_ids_expire_at", 0)) <= _now()
+    except Exception:
+        return True
+
+
+def _is_entry_expired(entry: dict[str, Any]) -> bool:
+    """Both tiers are gone: no local files and no long-lived file_ids."""
+    if not _entry_files_expired(entry):
+        return False
+    return not _entry_has_all_file_ids(entry) or _entry_file_ids_expired(entry)
+
+
+CACHE_DB_SCHEMA = """
+CREATE TABLE IF NOT EXISTS cache_entries (
+    key TEXT PRIMARY KEY,
+    media_id TEXT,
+    expires_at REAL NOT NULL,
+    file_ids_expire_at REAL NOT NULL DEFAULT 0,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_cache_entries_expires_at ON cache_entries(expires_at);
+CREATE INDEX IF NOT EXISTS idx_cache_entries_file_ids_expire_at ON cache_entries(file_ids_expire_at);
+CREATE INDEX IF NOT EXISTS idx_cache_entries_media_id ON cache_entries(media_id);
+
+CREATE TABLE IF NOT EXISTS cache_aliases (
+    alias_key TEXT PRIMARY KEY,
+    entry_key TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_cache_aliases_entry_key ON cache_aliases(entry_key);
+
+CREATE TABLE IF NOT EXISTS cookie_health (
+    site TEXT NOT NULL,
+    cookie TEXT NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (site, cookie)
+);
+
+CREATE TABLE IF NOT EXISTS cache_meta (
+    name TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+
+def _cache_db() -> sqlite3.Connection:
+    """Open the cache DB on first use. Callers must hold _cache_db_lock."""
+    global _cache_db_conn
+    if _cache_db_conn is None:
+        _ensure_dirs()
+        conn = sqlite3.connect(str(CACHE_DB_PATH), check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(CACHE_DB_SCHEMA)
+        _cache_db_conn = conn
+    return _cache_db_conn
+
+
+def _db_save_entry(entry: dict[str, Any]) -> None:
+    key = str(entry["key"])
+    aliases = [str(a) for a in entry.get("aliases") or []]
+    data = json.dumps({k: v for k, v in entry.items() if k != "aliases"}, ensure_ascii=False, separators=(",", ":"))
+    with _cache_db_lock:
+        conn = _cache_db()
+        with conn:
+            conn.execute(
+                "INSERT INTO cache_entries (key, media_id, expires_at, file_ids_expire_at, data) "
+                "VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET media_id = excluded.media_id, expires_at = excluded.expires_at, "
+                "file_ids_expire_at = excluded.file_ids_expire_at, data = excluded.data",
+                (
+                    key,
+                    entry.get("media_id"),
+                    float(entry.get("expires_at") or 0),
+                    float(entry.get("file_ids_expire_at") or 0),
+                    data,
+                ),
+            )
+            conn.execute("DELETE FROM cache_aliases WHERE entry_key = ?", (key,))
+            conn.executemany(
+                "INSERT OR REPLACE INTO cache_aliases (alias_key, entry_key) VALUES (?, ?)",
+                [(alias, key) for alias in aliases],
+            )
+
+
+def _db_delete_entry(key: str) -> None:
+    with _cache_db_lock:
+        conn = _cache_db()
+        with conn:
+            conn.execute("DELETE FROM cache_aliases WHERE entry_key = ?", (key,))
+            conn.execute("DELETE FROM cache_entries WHERE key = ?", (key,))
+
+
+def _db_expired_entries(now: float) -> list[dict[str, Any]]:
+    """Rows whose both tiers have expired (uses the expiry indexes)."""
+    with _cache_db_lock:
+        rows = _cache_db().execute(
+            "SELECT key, data FROM cache_entries WHERE expires_at <= ? AND file_ids_expire_at <= ?",
+            (now, now),
+        ).fetchall()
+    out: list[dict[str, Any]] = []
+    for key, data in rows:
+        try:
+            entry = json.loads(data)
+        except Exception:
+            entry = {}
+        entry["key"] = str(key)
+        out.append(entry)
+    return out
+
+
+def _migrate_meta_json_cache() -> None:
+    """One-time import of the old per-entry meta.json files into the cache DB."""
+    with _cache_db_lock:
+        done = _cache_db().execute("SELECT 1 FROM cache_meta WHERE name = 'meta_json_migrated'").fetchone()
+    if done:
+        return
+
+    migrated = 0
+    keys: set[str] = set()
+    for d in CACHE_DIR.iterdir():
+        meta_path = d / "meta.json"
+        if not d.is_dir() or not meta_path.exists():
+            continue
+        try:
+            entry = json.loads(meta_path.read_text(encoding="utf-8"))
+            url = str(entry.get("url") or "")
+            if not url or _is_entry_expired(entry) or _cache_key(url) in keys:
+                shutil.rmtree(d, ignore_errors=True)
+                continue
+            # older entries were keyed by the raw URL, which lookups no longer produce;
+            # the files stay where they are
+            entry["dir"] = str(entry.get("dir") or d.name)
+            entry["key"] = _cache_key(url)
+            entry["aliases"] = [a for a in entry.get("aliases") or [] if a != entry["key"]]
+            keys.add(entry["key"])
+            _db_save_entry(entry)
+            meta_path.unlink(missing_ok=True)
+            migrated += 1
+        except Exception as e:
+            logger.warning(f"Не удалось перенести кэш {d.name} в БД: {e}")
+
+    with _cache_db_lock:
+        conn = _cache_db()
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO cache_meta (name, value) VALUES ('meta_json_migrated', ?)", (str(_now()),))
+    if migrated:
+        logger.info(f"Кэш: перенесено {migrated} записей из meta.json в {CACHE_DB_PATH}")
+
+
+def _load_cache_index() -> None:
+    """Load any non-expired cache entries from the cache DB on startup."""
+    _ensure_dirs()
+    _migrate_meta_json_cache()
+
+    now = _now()
+    with _cache_db_lock:
+        conn = _cache_db()
+        rows = conn.execute(
+            "SELECT key, data FROM cache_entries WHERE expires_at > ? OR file_ids_expire_at > ?",
+            (now, now),
+        ).fetchall()
+        alias_rows = conn.execute("SELECT alias_key, entry_key FROM cache_aliases").fetchall()
+
+    aliases: dict[str, list[str]] = {}
+    for alias_key, entry_key in alias_rows:
+        aliases.setdefault(str(entry_key), []).append(str(alias_key))
+
+    loaded = 0
+    for key, data in rows:
+        try:
+            entry = json.loads(data)
+        except Exception:
+            continue
+        entry["key"] = str(key)
+        entry["aliases"] = aliases.get(str(key), [])
+        if _is_entry_expired(entry):
+            continue
+        _register_cache_entry(entry)
+        loaded += 1
+
+    _apply_cache_expiry(_snapshot_cache_expiry([("purge", entry) for entry in _db_expired_entries(now)]))
+
+    if loaded:
+        logger.info(f"Кэш загружен: {loaded} записей")
+
+
+def _register_cache_entry(entry: dict[str, Any]) -> None:
+    """Index entry under its key, its URL aliases and its media identity."""
+    key = str(entry["key"])
+    previous = _cache_index.get(key)
+    if previous is not None and previous is not entry and previous.get("key") == key:
+        # replaced before the cleanup job got to it (e.g. expired but not yet purged):
+        # its heap item goes stale with the key, so only a queued purge removes its files
+        _purge_cache_entry(key)
+    _cache_index[key] = entry
+    for alias in entry.get("aliases") or []:
+        _cache_index[str(alias)] = entry
+    media_id = entry.get("media_id")
+    if media_id:
+        _media_alias_index[str(media_id)] = key
+    _schedule_cache_expiry(entry)
+    _account_cache_bytes(entry)
+
+
+def _unregister_cache_entry(entry: dict[str, Any]) -> None:
+    key = str(entry["key"])
+    for k in [key, *(entry.get("aliases") or [])]:
+        if _cache_index.get(str(k)) is entry:
+            _cache_index.pop(str(k), None)
+    media_id = entry.get("media_id")
+    if media_id and _media_alias_index.get(str(media_id)) == key:
+        _media_alias_index.pop(str(media_id), None)
+    _cache_expiry_deadlines.pop(key, None)
+    _account_cache_bytes(entry, removed=True)
+
+
+def _account_cache_bytes(entry: dict[str, Any], *, removed: bool = False) -> None:
+    """Keep _cache_total_bytes in sync with the local files an entry holds."""
+    global _cache_total_bytes
+    key = str(entry["key"])
+    size = 0 if removed or entry.get("files_evicted") else int(entry.get("size_bytes") or 0)
+    _cache_total_bytes += size - _cache_entry_bytes.get(key, 0)
+    if size:
+        _cache_entry_bytes[key] = size
+    else:
+        _cache_entry_bytes.pop(key, None)
+
+
+def _touch_cache_entry(entry: dict[str, Any]) -> None:
+    """Record a cache hit and extend the local files lifetime up to CACHE_MAX_TTL_SECONDS."""
+    now = _now()
+    entry["hits"] = int(entry.get("hits") or 0) + 1
+    entry["last_hit_at"] = now
+    if not _entry_files_expired(entry):
+        cap = float(entry.get("created_at") or now) + float(CACHE_MAX_TTL_SECONDS)
+        extended = min(now + float(CACHE_TTL_SECONDS), cap)
+        if extended > float(entry.get("expires_at") or 0):
+            entry["expires_at"] = extended
+            _schedule_cache_expiry(entry)
+    _cache_dirty_keys.add(str(entry["key"]))
+
+
+def _cache_entry_score(entry: dict[str, Any], now: float) -> float:
+    """LRU/LFU hybrid: hit count decayed by time since the last access. Lowest is evicted first."""
+    last_access = float(entry.get("last_hit_at") or entry.get("created_at") or 0)
+    idle_ttls = max(0.0, now - last_access) / max(1.0, float(CACHE_TTL_SECONDS))
+    return (1 + int(entry.get("hits") or 0)) / (1 + idle_ttls)
+
+
+def _entry_next_deadline(entry: dict[str, Any]) -> float:
+    """When the entry needs attention next: local files expiry, then file_id tier expiry."""
+    field = "file_ids_expire_at" if entry.get("files_evicted") else "expires_at"
+    try:
+        return float(entry.get(field) or 0)
+    except Exception:
+        return 0.0
+
+
+def _schedule_cache_expiry(entry: dict[str, Any]) -> None:
+    key = str(entry["key"])
+    deadline = _entry_next_deadline(entry)
+    if _cache_expiry_deadlines.get(key) == deadline:
+        return
+    _cache_expiry_deadlines[key] = deadline
+    heapq.heappush(_cache_expiry_heap, (deadline, key))
+
+
+def _purge_cache_entry(key: str) -> None:
+    """Drop entry and its aliases from the index; files and row are deleted by clean_cache_job."""
+    entry = _cache_index.get(key)
+    if entry is None or not entry.get("key"):
+        return
+    _unregister_cache_entry(entry)
+    _cache_pending_purges.append(entry)
+
+
+def _pop_due_cache_entries(now: float) -> list[tuple[str, dict[str, Any]]]:
+    """Pop entries whose deadline has passed (memory only, O(log n) each).
+
+    Returns ("purge" | "evict", entry) pairs for _apply_cache_expiry.
+    """
+    due: list[tuple[str, dict[str, Any]]] = []
+    pinned: list[dict[str, Any]] = []
+    while _cache_expiry_heap and _cache_expiry_heap[0][0] <= now:
+        deadline, key = heapq.heappop(_cache_expiry_heap)
+        if _cache_expiry_deadlines.get(key) != deadline:
+            continue
+        del _cache_expiry_deadlines[key]
 
+        entry = _cache_index.get(key)
+        if entry is None or entry.get("key") != key:
+            continue
+        if key in _cache_pins:
+            # still uploading: looked at again on the next run
+            pinned.append(entry)
+            continue
+        if _is_entry_expired(entry):
+            _unregister_cache_entry(entry)
+            due.append(("purge", entry))
+        elif not entry.get("files_evicted"):
+            # local files expired, the file_id tier lives on
+            due.append(_evict_cache_files(entry))
+        else:
+            _schedule_cache_expiry(entry)
+    for entry in pinned:
+        _schedule_cache_expiry(entry)
 
-def _cache_dir_for_key(key: str) -> Path:
-    return CACHE_DIR / key
+    due.extend(("purge", entry) for entry in _cache_pending_purges)
+    _cache_pending_purges.clear()
+    return due
 
 
-def _meta_path_for_key(key: str) -> Path:
-    return _cache_dir_for_key(key) / "meta.json"
+def _evict_cache_files(entry: dict[str, Any]) -> tuple[str, dict[str, Any]]:
+    """Drop the local files tier of an entry (memory only). Entries without file_ids go entirely."""
+    if not _entry_has_all_file_ids(entry) or _entry_file_ids_expired(entry):
+        _unregister_cache_entry(entry)
+        return "purge", entry
+    entry["files_evicted"] = True
+    _schedule_cache_expiry(entry)
+    _account_cache_bytes(entry)
+    return "evict", entry
 
 
-def _now() -> float:
-    return time.time()
+def _pop_over_budget_entries(now: float) -> list[tuple[str, dict[str, Any]]]:
+    """Evict the least valuable local files until the cache fits CACHE_MAX_BYTES."""
+    if CACHE_MAX_BYTES <= 0 or _cache_total_bytes <= CACHE_MAX_BYTES:
+        return []
 
+    candidates = [_cache_index[key] for key in _cache_entry_bytes if key in _cache_index and key not in _cache_pins]
+    candidates.sort(key=lambda e: _cache_entry_score(e, now))
 
-def _is_entry_expired(entry: dict[str, Any]) -> bool:
-    try:
-        return float(entry.get("expires_at", 0)) <= _now()
-    except Exception:
-        return True
+    due: list[tuple[str, dict[str, Any]]] = []
+    for entry in candidates:
+        if _cache_total_bytes <= CACHE_MAX_BYTES:
+            break
+        due.append(_evict_cache_files(entry))
+    return due
 
 
-def _load_cache_index_from_disk() -> None:
-    """Load any non-expired cache entries from disk on startup."""
-    _ensure_dirs()
-    loaded = 0
-    for d in CACHE_DIR.iterdir():
-        if not d.is_dir():
-            continue
-        meta_path = d / "meta.json"
-        if not meta_path.exists():
-            continue
-        try:
-            entry = json.loads(meta_path.read_text(encoding="utf-8"))
-            key = str(entry.get("key") or d.name)
-            if _is_entry_expired(entry):
-                continue
-            _cache_index[key] = entry
-            loaded += 1
-        except Exception:
-            continue
-    if loaded:
-        logger.info(f"Кэш загружен: {loaded} записей")
+def _pop_dirty_cache_entries() -> list[tuple[str, dict[str, Any]]]:
+    due = [
+        ("save", _cache_index[key])
+        for key in _cache_dirty_keys
+        if key in _cache_index and _cache_index[key].get("key") == key
+    ]
+    _cache_dirty_keys.clear()
+    return due
 
 
-def _purge_cache_entry(key: str) -> None:
-    """Remove cache entry (meta + files)."""
-    try:
-        _cache_index.pop(key, None)
-        d = _cache_dir_for_key(key)
-        if d.exists() and d.is_dir():
-            shutil.rmtree(d, ignore_errors=True)
-    except Exception as e:
-        logger.warning(f"Не удалось удалить кэш {key}: {e}")
+def _snapshot_cache_expiry(due: list[tuple[str, dict[str, Any]]]) -> list[tuple[str, dict[str, Any]]]:
+    """Copy popped entries for _apply_cache_expiry (on the event loop, which keeps changing the live dicts).
 
+    A purged key that already belongs to a fresh download becomes "drop_files": its row stays.
+    """
+    out: list[tuple[str, dict[str, Any]]] = []
+    for action, entry in due:
+        if action == "purge" and str(entry["key"]) in _cache_index:
+            action = "drop_files"
+        out.append((action, copy.deepcopy(entry)))
+    return out
 
-def cleanup_cache() -> int:
-    """Delete expired cache entries. Returns deleted count."""
-    deleted = 0
-    # from memory
-    for key in list(_cache_index.keys()):
-        if _is_entry_expired(_cache_index[key]):
-            _purge_cache_entry(key)
-            deleted += 1
 
-    # also remove any expired leftovers on disk
-    for d in list(CACHE_DIR.iterdir()):
-        if not d.is_dir():
-            continue
-        meta_path = d / "meta.json"
-        if not meta_path.exists():
-            continue
+def _apply_cache_expiry(due: list[tuple[str, dict[str, Any]]]) -> None:
+    """Delete files and DB rows of snapshotted entries. Blocking: run off the event loop."""
+    for action, entry in due:
+        key = str(entry["key"])
         try:
-            entry = json.loads(meta_path.read_text(encoding="utf-8"))
-            if _is_entry_expired(entry):
-                shutil.rmtree(d, ignore_errors=True)
-                deleted += 1
-        except Exception:
-            # if meta is broken, remove after ttl window
-            pass
-
-    return deleted
+            if action == "save":
+                _db_save_entry(entry)
+                continue
+            shutil.rmtree(_cache_dir_for_entry(entry), ignore_errors=True)
+            if action == "evict":
+                _db_save_entry(entry)
+            elif action == "purge":
+                _db_delete_entry(key)
+        except Exception as e:
+            logger.warning(f"Не удалось удалить кэш {key}: {e}")
 
 
 async def clean_cache_job(context: ContextTypes.DEFAULT_TYPE) -> None:
-    deleted = cleanup_cache()
+    now = _now()
+    due = _pop_due_cache_entries(now)
+    over_budget = _pop_over_budget_entries(now)
+    due += over_budget + _pop_dirty_cache_entries()
+    cookie_rows = _pop_dirty_cookie_health()
+    if cookie_rows:
+        await asyncio.to_thread(_save_cookie_health, cookie_rows)
+    if TRANSCODE_CACHE_ENABLED:
+        removed, left = await asyncio.to_thread(_trim_transcode_cache)
+        if removed:
+            logger.info(f"Кэш перекодировок: удалено {removed} файлов под лимит (сейчас {left} байт)")
+    if not due:
+        return
+    await asyncio.to_thread(_apply_cache_expiry, _snapshot_cache_expiry(due))
+    deleted = sum(1 for action, _ in due if action == "purge")
     if deleted:
         logger.info(f"Кэш: удалено {deleted} просроченных записей")
+    if over_budget:
+        logger.info(
+            f"Кэш: освобождено место под лимит {CACHE_MAX_BYTES} байт, "
+            f"вытеснено {len(over_budget)} записей (сейчас {_cache_total_bytes} байт)"
+        )
 
 
 def _get_or_create_lock(key: str) -> asyncio.Lock:
@@ -394,39 +1769,41 @@ def _get_or_create_lock(key: str) -> asyncio.Lock:
     return lock
 
 
+@contextlib.asynccontextmanager
+async def _keyed_lock(key: str):
+    """Hold the lock for key; it is forgotten once nobody holds or waits for it."""
+    lock = _get_or_create_lock(key)
+    _cache_lock_users[key] += 1
+    try:
+        async with lock:
+            yield
+    finally:
+        _cache_lock_users[key] -= 1
+        if _cache_lock_users[key] <= 0:
+            del _cache_lock_users[key]
+            if _cache_locks.get(key) is lock:
+                del _cache_locks[key]
+
+
 def _cache_entry_is_usable(entry: dict[str, Any]) -> bool:
     if _is_entry_expired(entry):
         return False
     key = entry.get("key")
     if not key:
         return False
-    d = _cache_dir_for_key(str(key))
-    if not d.exists():
-        return False
     items = entry.get("items") or []
     if not isinstance(items, list) or not items:
         return False
 
     # if we have tg file_ids for all items, we don't need local files
-    all_have_ids = True
-    for it in items:
-        if not isinstance(it, dict):
-            all_have_ids = False
-            break
-        if not it.get("tg_file_id"):
-            all_have_ids = False
-            break
-    if all_have_ids:
+    all_have_ids = _entry_has_all_file_ids(entry)
+    if all_have_ids and not _entry_file_ids_expired(entry):
         return True
+    if _entry_files_expired(entry):
+        return False
 
-    # else check local files exist
-    for it in items:
-        fn = it.get("local_filename")
-        if not fn:
-            return False
-        if not (d / fn).exists():
-            return False
-    return True
+    # else rely on local files (kept until clean_cache_job evicts them; no disk I/O here)
+    return all(isinstance(it, dict) and it.get("local_filename") for it in items)
 
 
 def _classify_file(path: Path) -> str:
@@ -438,31 +1815,104 @@ def _classify_file(path: Path) -> str:
     return "document"
 
 
-def _probe_media(path: Path) -> dict[str, Any] | None:
+def _ffprobe_cmd(ffprobe_path: str, path: Path) -> list[str]:
+    return [ffprobe_path, "-v", "error", "-show_streams", "-show_format", "-of", "json", str(path)]
+
+
+async def _probe_media(path: Path) -> dict[str, Any] | None:
+    """ffprobe as an asyncio subprocess: no worker thread waits for it."""
     ffprobe_path = shutil.which("ffprobe")
     if ffprobe_path is None:
         return None
 
-    result = subprocess.run(
-        [
-            ffprobe_path,
-            "-v",
-            "error",
-            "-show_streams",
-            "-show_format",
-            "-of",
-            "json",
-            str(path),
-        ],
-        check=False,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        text=True,
-    )
-    if result.returncode != 0:
-        raise RuntimeError(result.stderr.strip() or f"ffprobe завершился с кодом {result.returncode}")
+    async with _probe_sema:
+        proc = await asyncio.create_subprocess_exec(
+            *_ffprobe_cmd(ffprobe_path, path),
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        try:
+            stdout, stderr = await proc.communicate()
+        except BaseException:
+            # cancelled caller: do not leave ffprobe running (or a zombie) behind
+            with contextlib.suppress(ProcessLookupError):
+                proc.kill()
+            await proc.wait()
+            raise
+    if proc.returncode != 0:
+        message = stderr.decode(errors="replace").strip()
+        raise RuntimeError(message or f"ffprobe завершился с кодом {proc.returncode}")
+
+    return json.loads(stdout or b"{}")
+
+
+# yt-dlp codec ids -> ffprobe codec names; anything else is left to ffprobe
+_YTDLP_VIDEO_CODECS = {"avc1": "h264", "avc3": "h264", "h264": "h264", "hev1": "hevc", "hvc1": "hevc",
+                       "h265": "hevc", "hevc": "hevc", "vp9": "vp9", "vp09": "vp9", "vp8": "vp8", "av01": "av1"}
+_YTDLP_AUDIO_CODECS = {"mp4a.40": "aac", "aac": "aac", "opus": "opus", "vorbis": "vorbis", "mp3": "mp3"}
+# H.264 profile_idc (first byte after "avc1.") of 8-bit 4:2:0 profiles: Baseline, Main, Extended, High
+_H264_YUV420P_PROFILES = {"42", "4d", "58", "64"}
+_CONTAINER_FORMAT_NAMES = {"mp4": "mov,mp4,m4a,3gp,3g2,mj2", "m4a": "mov,mp4,m4a,3gp,3g2,mj2",
+                           "mov": "mov,mp4,m4a,3gp,3g2,mj2", "webm": "matroska,webm", "mkv": "matroska,webm"}
+
+
+def _probe_from_ytdlp(download: dict[str, Any]) -> dict[str, Any] | None:
+    """ffprobe-shaped description of a downloaded file from yt-dlp's format fields.
+
+    None unless every field the iOS check needs is reliably known, including pix_fmt
+    (derived from the H.264 profile; other codecs are transcoded regardless of it).
+    """
+    container = _CONTAINER_FORMAT_NAMES.get(str(download.get("ext") or "").lower())
+    vcodec = str(download.get("vcodec") or "").lower()
+    acodec = str(download.get("acodec") or "").lower()
+    if container is None or not vcodec or not acodec or vcodec == "none":
+        return None
 
-    return json.loads(result.stdout or "{}")
+    video_codec = next((v for k, v in _YTDLP_VIDEO_CODECS.items() if vcodec.startswith(k)), None)
+    if video_codec is None:
+        return None
+    pix_fmt = str(download.get("pix_fmt") or "")
+    if video_codec == "h264" and not pix_fmt:
+        profile = vcodec.partition(".")[2][:2]
+        if profile not in _H264_YUV420P_PROFILES:
+            return None
+        pix_fmt = "yuv420p"
+    video_stream: dict[str, Any] = {"codec_type": "video", "codec_name": video_codec, "pix_fmt": pix_fmt}
+    # optional: only used to size transcodes
+    for key in ("width", "height"):
+        if download.get(key):
+            video_stream[key] = int(download[key])
+    if download.get("fps"):
+        video_stream["avg_frame_rate"] = f"{float(download['fps']):g}/1"
+    streams: list[dict[str, Any]] = [video_stream]
+
+    if acodec != "none":
+        audio_codec = next((v for k, v in _YTDLP_AUDIO_CODECS.items() if acodec.startswith(k)), None)
+        if audio_codec is None:
+            return None
+        audio_stream: dict[str, Any] = {"codec_type": "audio", "codec_name": audio_codec}
+        # optional: a track within the transcode's audio budget is copied instead of re-encoded
+        if download.get("abr"):
+            audio_stream["bit_rate"] = str(int(float(download["abr"]) * 1000))
+        streams.append(audio_stream)
+    format_info: dict[str, Any] = {"format_name": container}
+    if download.get("duration"):
+        format_info["duration"] = str(download["duration"])
+    return {"format": format_info, "streams": streams, "source": "yt-dlp"}
+
+
+def _probes_from_ytdlp_result(result: Any) -> dict[str, dict[str, Any]]:
+    """File name -> ffprobe-shaped info for every downloaded file yt-dlp described reliably."""
+    probes: dict[str, dict[str, Any]] = {}
+    for entry in _iter_entries(result):
+        for download in entry.get("requested_downloads") or []:
+            filepath = download.get("filepath")
+            if filepath and not download.get("duration") and entry.get("duration"):
+                download = {**download, "duration": entry["duration"]}
+            probe = _probe_from_ytdlp(download) if filepath else None
+            if probe is not None:
+                probes[Path(filepath).name] = probe
+    return probes
 
 
 def _collect_downloaded_files(workdir: Path) -> list[Path]:
@@ -480,6 +1930,18 @@ def _collect_downloaded_files(workdir: Path) -> list[Path]:
     return files
 
 
+def _reset_dir(path: Path) -> None:
+    if path.exists():
+        shutil.rmtree(path, ignore_errors=True)
+    path.mkdir(parents=True, exist_ok=True)
+
+
+def _extract_in_clean_dir(url: str, workdir: Path, *, cookiefile: str | None, site: str) -> dict[str, Any]:
+    """_extract_media in an emptied workdir (leftovers of a previous attempt removed)."""
+    _reset_dir(workdir)
+    return _extract_media(url, workdir, cookiefile=cookiefile, site=site)
+
+
 def _cleanup_tmp_dir(workdir: Path) -> None:
     for p in workdir.glob("*"):
         try:
@@ -491,13 +1953,34 @@ def _cleanup_tmp_dir(workdir: Path) -> None:
             pass
 
 
-def _stream_kinds_for_file(path: Path) -> tuple[bool, bool]:
-    try:
-        probe = _probe_media(path)
-    except Exception as e:
-        logger.warning("Не удалось определить тип медиа %s: %s", path.name, e)
-        probe = None
+async def _probe_downloaded_files(
+    files: list[Path],
+    known: dict[str, dict[str, Any]],
+) -> dict[str, dict[str, Any] | None]:
+    """One probe per non-photo file: yt-dlp's description if reliable, else ffprobe (concurrently)."""
+    probes: dict[str, dict[str, Any] | None] = {}
+    to_probe: list[Path] = []
+    for path in files:
+        if _classify_file(path) == "photo":
+            continue
+        if path.name in known:
+            probes[path.name] = known[path.name]
+        else:
+            to_probe.append(path)
 
+    results = await asyncio.gather(*(_probe_media(path) for path in to_probe), return_exceptions=True)
+    for path, probe in zip(to_probe, results):
+        if isinstance(probe, BaseException):
+            logger.warning("Не удалось определить тип медиа %s: %s", path.name, probe)
+            probe = None
+        probes[path.name] = probe
+    reused = len(probes) - len(to_probe)
+    if reused:
+        logger.info(f"ffprobe пропущен для {reused} файлов: хватило данных yt-dlp")
+    return probes
+
+
+def _stream_kinds_for_file(path: Path, probe: dict[str, Any] | None) -> tuple[bool, bool]:
     if not probe:
         ext = path.suffix.lower()
         return ext in VIDEO_EXTENSIONS, ext in AUDIO_EXTENSIONS
@@ -508,7 +1991,10 @@ def _stream_kinds_for_file(path: Path) -> tuple[bool, bool]:
     return has_video, has_audio
 
 
-def _select_primary_downloads(files: list[Path]) -> tuple[list[Path], list[Path]]:
+def _select_primary_downloads(
+    files: list[Path],
+    probes: dict[str, dict[str, Any] | None],
+) -> tuple[list[Path], list[Path]]:
     visual_files: list[Path] = []
     audio_only_files: list[Path] = []
     other_files: list[Path] = []
@@ -519,7 +2005,7 @@ def _select_primary_downloads(files: list[Path]) -> tuple[list[Path], list[Path]
             visual_files.append(path)
             continue
 
-        has_video, has_audio = _stream_kinds_for_file(path)
+        has_video, has_audio = _stream_kinds_for_file(path, probes.get(path.name))
         if has_video:
             visual_files.append(path)
         elif has_audio or path.suffix.lower() in AUDIO_EXTENSIONS:
@@ -569,35 +2055,94 @@ def _needs_ios_video_normalization(path: Path, probe: dict[str, Any]) -> tuple[b
 
 
 def _unique_ios_output_path(path: Path) -> Path:
+    """Reserve a free <stem>_ios.mp4 name (created empty: items are normalized concurrently)."""
     candidate = path.with_name(f"{path.stem}_ios.mp4")
     counter = 1
-    while candidate.exists():
-        candidate = path.with_name(f"{path.stem}_ios_{counter}.mp4")
-        counter += 1
-    return candidate
+    while True:
+        try:
+            candidate.touch(exist_ok=False)
+            return candidate
+        except FileExistsError:
+            candidate = path.with_name(f"{path.stem}_ios_{counter}.mp4")
+            counter += 1
 
 
-def _ios_video_filter() -> str:
+def _ios_video_filter(max_height: int = IOS_TRANSCODE_MAX_HEIGHT) -> str:
+    max_width = IOS_TRANSCODE_MAX_WIDTH * max_height // IOS_TRANSCODE_MAX_HEIGHT
     return (
-        f"scale=w='min({IOS_TRANSCODE_MAX_WIDTH},iw)':"
-        f"h='min({IOS_TRANSCODE_MAX_HEIGHT},ih)':"
+        f"scale=w='min({max_width},iw)':"
+        f"h='min({max_height},ih)':"
         "force_original_aspect_ratio=decrease,"
         "scale=trunc(iw/2)*2:trunc(ih/2)*2,"
         f"fps={IOS_TRANSCODE_MAX_FPS}"
     )
 
 
-def _normalize_video_for_ios(path: Path) -> Path:
+def _probe_duration(probe: dict[str, Any]) -> float:
+    for source in [probe.get("format") or {}, *(probe.get("streams") or [])]:
+        try:
+            duration = float(source.get("duration") or 0)
+        except (TypeError, ValueError):
+            continue
+        if duration > 0:
+            return duration
+    return 0.0
+
+
+def _stream_fps(stream: dict[str, Any]) -> float:
+    num, _, den = str(stream.get("avg_frame_rate") or stream.get("r_frame_rate") or "").partition("/")
+    try:
+        fps = float(num) / float(den or 1)
+    except (ValueError, ZeroDivisionError):
+        return float(IOS_TRANSCODE_MAX_FPS)
+    return min(fps, float(IOS_TRANSCODE_MAX_FPS)) if fps > 0 else float(IOS_TRANSCODE_MAX_FPS)
+
+
+def _scaled_pixels(stream: dict[str, Any], max_height: int) -> int:
+    """Frame area after _ios_video_filter(max_height) (the whole box when the source size is unknown)."""
+    box_w = IOS_TRANSCODE_MAX_WIDTH * max_height // IOS_TRANSCODE_MAX_HEIGHT
+    box_h = max_height
+    width, height = int(stream.get("width") or 0), int(stream.get("height") or 0)
+    if width <= 0 or height <= 0:
+        return box_w * box_h
+    scale = min(1.0, box_w / width, box_h / height)
+    return int(width * scale) * int(height * scale)
+
+
+def _target_size_plan(probe: dict[str, Any], video_stream: dict[str, Any]) -> dict[str, int] | None:
+    """Bitrates and max height so a transcode of this file fits MAX_SIZE_MB in one pass.
+
+    The budget leaves 5% for the container; the video VBV buffer (two seconds of maxrate)
+    is reserved too, because a VBV-constrained encode can overshoot maxrate x duration by
+    at most the buffer. None when the duration is unknown.
+    """
+    duration = _probe_duration(probe)
+    if duration <= 0:
+        return None
+
+    total_kbps = MAX_SIZE_MB * 1024 * 1024 * 8 * 0.95 / duration / 1000
+    audio_kbps = 192 if total_kbps >= 1500 else 128 if total_kbps >= 600 else 64
+    video_kbps = int((total_kbps - audio_kbps) * duration / (duration + 2))
+
+    fps = _stream_fps(video_stream)
+    heights = [h for h in TRANSCODE_HEIGHT_LADDER if h < IOS_TRANSCODE_MAX_HEIGHT]
+    for max_height in [IOS_TRANSCODE_MAX_HEIGHT, *heights]:
+        if video_kbps * 1000 / (_scaled_pixels(video_stream, max_height) * fps) >= TRANSCODE_MIN_BPP:
+            break
+    return {"video_kbps": video_kbps, "audio_kbps": audio_kbps, "max_height": max_height}
+
+
+async def _normalize_video_for_ios(path: Path, probe: dict[str, Any] | None = None) -> Path:
     if _classify_file(path) != "video":
         return path
 
     ffmpeg_path = shutil.which("ffmpeg")
-    ffprobe_path = shutil.which("ffprobe")
-    if ffmpeg_path is None or ffprobe_path is None:
+    if ffmpeg_path is None or (probe is None and shutil.which("ffprobe") is None):
         logger.warning("Пропускаю проверку совместимости видео: ffmpeg/ffprobe недоступны")
         return path
 
-    probe = _probe_media(path)
+    if probe is None:
+        probe = await _probe_media(path)
     if probe is None:
         return path
 
@@ -611,11 +2156,15 @@ def _normalize_video_for_ios(path: Path) -> Path:
     if video_stream is None:
         return path
 
-    target = _unique_ios_output_path(path)
-
+    threads = str(TRANSCODER.threads)
     cmd = [
         ffmpeg_path,
         "-y",
+        "-filter_threads",
+        threads,
+        # decoder threads (input option); the encoder gets its own -threads below
+        "-threads",
+        threads,
         "-i",
         str(path),
         "-map",
@@ -647,6 +2196,29 @@ def _normalize_video_for_ios(path: Path) -> Path:
         )
         return path
 
+    plan = None
+    if needs_video_transcode and TRANSCODE_TARGET_SIZE:
+        plan = _target_size_plan(probe, video_stream)
+        if plan is not None and plan["video_kbps"] < TRANSCODE_MIN_VIDEO_KBPS:
+            if path.stat().st_size <= MAX_SIZE_MB * 1024 * 1024:
+                # the download already fits the limit; an unwatchable re-encode would not help
+                logger.warning(
+                    "Пропускаю перекодировку %s: в %s MB помещается только %s кбит/с видео",
+                    path.name,
+                    MAX_SIZE_MB,
+                    plan["video_kbps"],
+                )
+                return path
+            # too large either way: a plain CRF encode may still fit, the size check decides
+            plan = None
+        elif plan is None:
+            logger.info("Длительность %s неизвестна — перекодирую без ограничения размера", path.name)
+
+    audio_kbps = plan["audio_kbps"] if plan else 192
+    if audio_copy_ok and plan:
+        # a copied track must fit the audio share of the budget too
+        audio_copy_ok = 0 < int(audio_stream.get("bit_rate") or 0) <= audio_kbps * 1000
+
     if video_copy_ok:
         cmd.extend(["-c:v", "copy"])
     else:
@@ -658,64 +2230,184 @@ def _normalize_video_for_ios(path: Path) -> Path:
             "-crf",
             str(IOS_TRANSCODE_CRF),
             "-vf",
-            _ios_video_filter(),
+            _ios_video_filter(plan["max_height"] if plan else IOS_TRANSCODE_MAX_HEIGHT),
             "-pix_fmt",
             "yuv420p",
         ])
+        if plan:
+            # CRF keeps easy clips small; VBV caps the rest at the size budget
+            cmd.extend([
+                "-maxrate",
+                f"{plan['video_kbps']}k",
+                "-bufsize",
+                f"{plan['video_kbps'] * 2}k",
+            ])
+            reason += f", ≤{plan['video_kbps']} кбит/с, ≤{plan['max_height']}p"
 
     if audio_stream:
         if audio_copy_ok:
             cmd.extend(["-c:a", "copy"])
         else:
-            cmd.extend(["-c:a", "aac", "-b:a", "192k"])
-
-    cmd.extend(["-movflags", "+faststart", str(target)])
+            cmd.extend(["-c:a", "aac", "-b:a", f"{audio_kbps}k"])
 
+    target = _unique_ios_output_path(path)
+    cmd.extend(["-threads", threads, "-movflags", "+faststart", str(target)])
+
+    # short clips never wait for heavy-lane transcodes
+    heavy = needs_video_transcode and _current_lane.get() == "heavy"
+    if not (needs_video_transcode and TRANSCODE_CACHE_ENABLED):
+        return await _run_ios_transcode(path, target, cmd, reason, heavy=heavy)
+
+    digest = await PROCESS_STAGE.run(_transcode_cache_key, path, cmd)
+    cached = TRANSCODE_CACHE_DIR / f"{digest}.mp4"
+    # identical sources arriving together are encoded once
+    async with _keyed_lock(f"transcode:{digest}"):
+        if await PROCESS_STAGE.run(_link_cached_transcode, cached, target):
+            logger.info("Перекодированное видео для %s взято из кэша (%s)", path.name, digest[:12])
+            path.unlink(missing_ok=True)
+            return target
+        result = await _run_ios_transcode(path, target, cmd, reason, heavy=heavy)
+        if result == target:
+            await PROCESS_STAGE.run(_store_cached_transcode, target, cached)
+        return result
+
+
+async def _run_ios_transcode(path: Path, target: Path, cmd: list[str], reason: str, *, heavy: bool) -> Path:
     logger.info("Нормализую видео для iPhone: %s (%s)", path.name, reason)
-    if needs_video_transcode:
-        logger.info(
-            "Ожидаю слот перекодировки iPhone для %s (max_parallel=%d)",
-            path.name,
-            IOS_TRANSCODE_MAX_PARALLEL,
-        )
+    try:
+        await TRANSCODER.run(cmd, label=path.name, heavy=heavy)
+    except BaseException:
+        target.unlink(missing_ok=True)
+        raise
 
-    if needs_video_transcode:
-        with ios_transcode_sema:
-            result = subprocess.run(
-                cmd,
-                check=False,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True,
-            )
-    else:
-        result = subprocess.run(
-            cmd,
-            check=False,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True,
-        )
-    if result.returncode != 0:
+    limit = MAX_SIZE_MB * 1024 * 1024
+    size = target.stat().st_size
+    if size > limit >= path.stat().st_size:
+        logger.warning("Перекодированный %s больше %s MB — отправляю исходный файл", path.name, MAX_SIZE_MB)
         target.unlink(missing_ok=True)
-        raise RuntimeError(result.stderr.strip() or f"ffmpeg завершился с кодом {result.returncode}")
+        return path
+    if size > limit:
+        # neither file can be sent (unknown duration, or a budget too small to target)
+        target.unlink(missing_ok=True)
+        raise MediaPolicyError(f"Видео слишком большое: ~{size / (1024 * 1024):.0f} MB. Максимум: {MAX_SIZE_MB} MB.")
 
     path.unlink(missing_ok=True)
     return target
 
 
-def _normalize_downloaded_files(files: list[Path]) -> list[Path]:
-    normalized: list[Path] = []
-    for path in files:
+def _transcode_cache_key(source: Path, cmd: list[str]) -> str:
+    """sha256 of the source bytes and the ffmpeg arguments that shape the output.
+
+    Paths and thread counts are left out: they differ between runs without changing the result.
+    """
+    params: list[str] = []
+    skip = False
+    for arg in cmd[1:]:
+        if skip:
+            skip = False
+        elif arg in ("-threads", "-filter_threads"):
+            skip = True
+        elif arg not in (str(source), cmd[-1]):
+            params.append(arg)
+
+    digest = hashlib.sha256()
+    with source.open("rb") as f:
+        for chunk in iter(functools.partial(f.read, 1024 * 1024), b""):
+            digest.update(chunk)
+    digest.update("\0".join(params).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def _link_or_copy(src: Path, dst: Path) -> None:
+    try:
+        os.link(src, dst)
+    except OSError as e:
+        # WORK_DIR and the cache on different filesystems, or no hard link support
+        logger.warning("Не удалось создать жёсткую ссылку %s (%s), копирую", dst.name, e)
+        shutil.copy2(src, dst)
+
+
+def _link_cached_transcode(cached: Path, target: Path) -> bool:
+    """Hard-link a cached transcode to target (replacing the reserved name); False on a cache miss."""
+    if not cached.exists():
+        return False
+    target.unlink(missing_ok=True)
+    try:
+        _link_or_copy(cached, target)
+    except FileNotFoundError:
+        return False
+    with contextlib.suppress(OSError):
+        # mtime marks the last use for _trim_transcode_cache
+        os.utime(cached)
+    return True
+
+
+def _store_cached_transcode(target: Path, cached: Path) -> None:
+    tmp = cached.with_name(f"{cached.name}.{os.getpid()}.tmp")
+    try:
+        _link_or_copy(target, tmp)
+        os.replace(tmp, cached)
+    except OSError as e:
+        tmp.unlink(missing_ok=True)
+        logger.warning("Не удалось сохранить перекодированное видео в кэш: %s", e)
+
+
+def _trim_transcode_cache() -> tuple[int, int]:
+    """Drop least recently used outputs until the transcode cache fits its budget.
+
+    Also removes .tmp files that _store_cached_transcode left behind (another process,
+    or older than an hour). Returns (removed files, bytes left). Blocking: run off the event loop.
+    """
+    removed = 0
+    own_suffix = f".{os.getpid()}.tmp"
+    for fp in TRANSCODE_CACHE_DIR.glob("*.tmp"):
+        with contextlib.suppress(OSError):
+            if not fp.name.endswith(own_suffix) or fp.stat().st_mtime < time.time() - 3600:
+                fp.unlink()
+                removed += 1
+
+    files: list[tuple[float, int, Path]] = []
+    for fp in TRANSCODE_CACHE_DIR.glob("*.mp4"):
+        with contextlib.suppress(OSError):
+            st = fp.stat()
+            files.append((st.st_mtime, st.st_size, fp))
+    total = sum(size for _, size, _ in files)
+    if TRANSCODE_CACHE_MAX_BYTES > 0:
+        for _, size, fp in sorted(files):
+            if total <= TRANSCODE_CACHE_MAX_BYTES:
+                break
+            # links already handed to the media cache keep their data
+            fp.unlink(missing_ok=True)
+            total -= size
+            removed += 1
+    return removed, total
+
+
+async def _normalize_downloaded_files(
+    files: list[Path],
+    probes: dict[str, dict[str, Any] | None] | None = None,
+) -> list[Path]:
+    """Normalize the items of one link concurrently; the result keeps the order of files."""
+    sema = asyncio.Semaphore(ITEM_PROCESS_MAX_PARALLEL)
+
+    async def _normalize_one(path: Path) -> Path:
         if _classify_file(path) != "video":
-            normalized.append(path)
-            continue
+            return path
         try:
-            normalized.append(_normalize_video_for_ios(path))
+            async with sema:
+                return await _normalize_video_for_ios(path, (probes or {}).get(path.name))
+        except MediaPolicyError:
+            raise
         except Exception as e:
             logger.warning("Не удалось нормализовать видео %s: %s", path.name, e)
-            normalized.append(path)
-    return normalized
+            return path
+
+    # a file that cannot fit MAX_SIZE_MB fails the link, but only after its siblings are done
+    results = await asyncio.gather(*(_normalize_one(path) for path in files), return_exceptions=True)
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    return list(results)
 
 
 def _ytdlp_common_opts(outtmpl: str, cookiefile: str | None = None, proxy: str | None = None) -> dict[str, Any]:
@@ -739,115 +2431,702 @@ def _ytdlp_common_opts(outtmpl: str, cookiefile: str | None = None, proxy: str |
     return opts
 
 
-def _iter_entries(info: Any) -> Iterable[dict[str, Any]]:
-    if isinstance(info, dict) and info.get("entries"):
-        entries = info["entries"]
-        # yt-dlp may return a generator
-        for e in entries:
-            if e:
-                yield e
-    elif isinstance(info, dict):
-        yield info
+def _iter_entries(info: Any) -> Iterable[dict[str, Any]]:
+    if isinstance(info, dict) and info.get("entries"):
+        entries = info["entries"]
+        # yt-dlp may return a generator
+        for e in entries:
+            if e:
+                yield e
+    elif isinstance(info, dict):
+        yield info
+
+def _extract_ig_story_id(url: str) -> str | None:
+    """Extract numeric story id from an Instagram /stories/<user>/<id>/ URL."""
+    m = re.search(r"/stories/[^/]+/(\d+)", url)
+    return m.group(1) if m else None
+
+
+def _extract_ig_story_user(url: str) -> str | None:
+    """Username of an Instagram /stories/<user>/<id>/ URL (None for highlights)."""
+    m = re.search(r"/stories/([^/?#]+)/\d+", url)
+    if not m or m.group(1) == "highlights":
+        return None
+    return m.group(1)
+
+
+def _ig_url_may_have_photos(url: str) -> bool:
+    """False for Instagram reel/IGTV URLs: those are always videos, never photos."""
+    return not re.search(r"/(?:reels?|tv)/[^/?#]+", url)
+
+
+def _ig_media_ids(wanted_id: str) -> set[str]:
+    """A numeric media pk plus the shortcode form yt-dlp uses as entry id."""
+    ids = {wanted_id}
+    if wanted_id.isdigit():
+        ids.add(encode_base_n(int(wanted_id), table=IG_SHORTCODE_CHARS))
+    return ids
+
+
+def _tray_has_entry(info: Any, wanted_id: str) -> bool:
+    ids = _ig_media_ids(wanted_id)
+    return any(str(e.get("id") or "") in ids for e in _iter_entries(info))
+
+
+def _extract_story_tray(
+    user: str, workdir: Path, *, cookiefile: str | None, site: str, fresh: bool = False
+) -> tuple[dict[str, Any], bool]:
+    """Sanitized story playlist of user, shared for IG_STORY_TRAY_TTL_SECONDS.
+
+    Concurrent calls for one user wait for a single extraction, at most
+    IG_STORY_TRAY_WAIT_SECONDS; if it fails or takes longer, waiters extract with their
+    own cookie instead. Returns (tray, whether cookiefile was used to extract it).
+    """
+    owner = False
+    with _story_tray_lock:
+        cached = _story_tray_cache.get(user)
+        if cached and cached[0] > _now() and not fresh:
+            return copy.deepcopy(cached[1]), False
+        future = _story_tray_inflight.get(user)
+        if future is None:
+            future = Future()
+            _story_tray_inflight[user] = future
+            owner = True
+
+    if not owner:
+        try:
+            # the owner always resolves the future, with the tray or its error
+            return copy.deepcopy(future.result(timeout=IG_STORY_TRAY_WAIT_SECONDS)), False
+        except FutureTimeoutError:
+            logger.info(f"[{site}] Сторис {user}: общее извлечение идёт дольше {IG_STORY_TRAY_WAIT_SECONDS:g} с, извлекаю сам")
+        except Exception:
+            pass
+
+    tray_url = f"https://www.instagram.com/stories/{user}/"
+    try:
+        with YoutubeDL(_build_ydl_opts(workdir, cookiefile=cookiefile, site=site, fmt=VIDEO_FORMAT, photos=True)) as ydl:
+            tray = YoutubeDL.sanitize_info(ydl.extract_info(tray_url, download=False))
+    except BaseException as e:
+        if owner:
+            with _story_tray_lock:
+                _story_tray_inflight.pop(user, None)
+            future.set_exception(e)
+        raise
+
+    with _story_tray_lock:
+        while len(_story_tray_cache) >= METADATA_CACHE_MAX_ENTRIES:
+            _story_tray_cache.pop(next(iter(_story_tray_cache)), None)
+        _story_tray_cache.pop(user, None)
+        _story_tray_cache[user] = (_now() + IG_STORY_TRAY_TTL_SECONDS, tray)
+        if owner:
+            _story_tray_inflight.pop(user, None)
+    if owner:
+        future.set_result(tray)
+        logger.info(f"[{site}] Сторис {user}: {len(list(_iter_entries(tray)))} шт. (кэш на {IG_STORY_TRAY_TTL_SECONDS} с)")
+    return copy.deepcopy(tray), True
+
+
+def _filter_entries_by_id(info: Any, wanted_id: str) -> Any:
+    """If info is a playlist-like dict, keep only entry matching wanted_id (best effort)."""
+    if not wanted_id:
+        return info
+    if not isinstance(info, dict) or not info.get("entries"):
+        return info
+
+    entries = list(info.get("entries") or [])
+    wanted_ids = _ig_media_ids(wanted_id)
+    filtered: list[dict] = []
+    for e in entries:
+        if not isinstance(e, dict):
+            continue
+        eid = str(e.get("id") or e.get("display_id") or e.get("media_id") or "")
+        if eid in wanted_ids:
+            filtered.append(e)
+
+    if not filtered:
+        return info
+
+    out = dict(info)
+    out["entries"] = filtered
+    return out
+
+
+
+def _total_duration(info: Any) -> float:
+    return float(sum(entry.get("duration") or 0 for entry in _iter_entries(info)))
+
+
+def _estimated_filesize(info: Any) -> int:
+    """Sum of (approximate) sizes of the formats yt-dlp selected, 0 if unknown."""
+    total = 0
+    for entry in _iter_entries(info):
+        for fmt in entry.get("requested_formats") or [entry]:
+            total += int(fmt.get("filesize") or fmt.get("filesize_approx") or 0)
+    return total
+
+
+def _check_duration_limit(info: Any) -> None:
+    for entry in _iter_entries(info):
+        dur = entry.get("duration")
+        if dur and dur > MAX_DURATION_SEC:
+            raise MediaPolicyError(
+                f"Видео слишком длинное: {int(dur)} сек. Максимум: {MAX_DURATION_SEC} сек."
+            )
+
+
+def _format_has_video(fmt: dict[str, Any]) -> bool:
+    vcodec = fmt.get("vcodec")
+    if vcodec == "none":
+        return False
+    # unknown codec: trust the extension (audio-only formats often lack codec fields)
+    return vcodec is not None or f".{fmt.get('ext') or ''}" not in AUDIO_EXTENSIONS
+
+
+def _format_has_audio(fmt: dict[str, Any]) -> bool:
+    return fmt.get("acodec") != "none"
+
+
+def _format_size(fmt: dict[str, Any], duration: float) -> float | None:
+    """Bytes from filesize / filesize_approx / tbr x duration; None if unknown."""
+    size = fmt.get("filesize") or fmt.get("filesize_approx")
+    if size:
+        return float(size)
+    tbr = fmt.get("tbr") or ((fmt.get("vbr") or 0) + (fmt.get("abr") or 0))
+    if tbr and duration:
+        return float(tbr) * 1000 / 8 * duration
+    return None
+
+
+def _is_ios_safe_combo(combo: tuple[dict[str, Any], ...]) -> bool:
+    """True when the result needs no _normalize_video_for_ios (h264 + aac in mp4)."""
+    video = combo[0]
+    vcodec = str(video.get("vcodec") or "").lower()
+    if not vcodec.startswith(("avc1", "h264")):
+        return False
+    audio = combo[1] if len(combo) > 1 else video
+    acodec = str(audio.get("acodec") or "").lower()
+    if acodec not in {"none", ""} and not acodec.startswith(("mp4a", "aac")):
+        return False
+    # a single file keeps its container; pairs are merged into MERGE_OUTPUT_FORMAT
+    container = MERGE_OUTPUT_FORMAT if len(combo) > 1 else str(video.get("ext") or "")
+    return container in {"mp4", "m4v", "mov"}
+
+
+def _plan_entry_formats(entry: dict[str, Any]) -> tuple[dict[str, Any], ...] | None:
+    """Best format combination of one entry that fits under MAX_SIZE_MB.
+
+    Ranking: known to fit > unknown size > too big, then iOS-safe, then resolution
+    and bitrate, with the audio language yt-dlp prefers (original track over dubs)
+    before audio bitrate. Remaining ties follow yt-dlp's own preference and format
+    order (worst to best). DRM formats are never picked. None if the entry has no
+    video formats (photo or audio-only media). Raises MediaPolicyError when every
+    combination is known to be too big.
+    """
+    formats = [
+        f for f in entry.get("formats") or [] if isinstance(f, dict) and f.get("format_id") and not f.get("has_drm")
+    ]
+    order = {id(f): i for i, f in enumerate(formats)}
+    videos = [f for f in formats if _format_has_video(f)]
+    if not videos:
+        return None
+    audios = [f for f in formats if not _format_has_video(f) and _format_has_audio(f)]
+    duration = float(entry.get("duration") or 0)
+    # leave a little room for container overhead when merging
+    budget = MAX_SIZE_MB * 1024 * 1024 * 0.95
+
+    combos: list[tuple[dict[str, Any], ...]] = []
+    for video in videos:
+        if _format_has_audio(video) or not audios:
+            combos.append((video,))
+        else:
+            combos.extend((video, audio) for audio in audios)
+
+    def _preference(fmt: dict[str, Any]) -> tuple[float, float, int]:
+        # yt-dlp's extractor-given preference, then its format order
+        return (fmt.get("preference") or 0, fmt.get("quality") or 0, order[id(fmt)])
+
+    def _rank(combo: tuple[dict[str, Any], ...]) -> tuple[Any, ...]:
+        sizes = [_format_size(f, duration) for f in combo]
+        size = None if any(v is None for v in sizes) else sum(sizes)
+        fits = 1 if size is None else (2 if size <= budget else 0)
+        video = combo[0]
+        audio = combo[-1]
+        audio_rate = (audio.get("abr") or audio.get("tbr") or 0) if len(combo) > 1 else 0
+        language = audio.get("language_preference")
+        return (
+            fits,
+            _is_ios_safe_combo(combo),
+            video.get("height") or 0,
+            video.get("tbr") or 0,
+            -1 if language is None else language,
+            audio_rate,
+            -(size or 0),
+            _preference(video),
+            _preference(audio),
+        )
+
+    best = max(combos, key=_rank)
+    if _rank(best)[0] == 0:
+        smallest = min(sum(_format_size(f, duration) or 0 for f in combo) for combo in combos)
+        raise MediaPolicyError(
+            f"Видео слишком большое: ~{smallest / (1024 * 1024):.0f} MB. Максимум: {MAX_SIZE_MB} MB."
+        )
+    return best
+
+
+def _plan_formats(info: dict[str, Any]) -> tuple[str, int]:
+    """Narrow each entry's formats to its planned combination (in place).
+
+    Returns the format spec to download with and the planned size in bytes (0 if unknown).
+    Entries without video formats are left alone; if no entry could be planned the
+    configured VIDEO_FORMAT is kept, switching to VIDEO_FORMAT_FALLBACK up front when
+    it selected audio although the media has video.
+    """
+    planned = 0
+    total = 0
+    for entry in _iter_entries(info):
+        combo = _plan_entry_formats(entry) if SIZE_AWARE_FORMAT else None
+        if combo is None:
+            continue
+        entry["formats"] = list(combo)
+        entry.pop("requested_formats", None)
+        planned += 1
+        duration = float(entry.get("duration") or 0)
+        total += int(sum(_format_size(f, duration) or 0 for f in combo))
+    if planned:
+        return PLANNED_FORMAT, total
+
+    for entry in _iter_entries(info):
+        selected = entry.get("requested_formats") or [entry]
+        if not any(_format_has_video(f) for f in selected) and any(
+            _format_has_video(f) for f in entry.get("formats") or []
+        ):
+            logger.info("VIDEO_FORMAT выбирает только аудио, использую VIDEO_FORMAT_FALLBACK")
+            return VIDEO_FORMAT_FALLBACK, 0
+    return VIDEO_FORMAT, 0
+
+
+def _media_identity(info: Any) -> str | None:
+    """Stable "<extractor_key>:<id>" of extracted media (a single entry if only one is left)."""
+    if not isinstance(info, dict):
+        return None
+    target = info
+    entries = info.get("entries")
+    if entries and isinstance(entries, list) and len(entries) == 1 and isinstance(entries[0], dict):
+        target = entries[0]
+    extractor = target.get("extractor_key") or target.get("ie_key") or info.get("extractor_key")
+    media_id = target.get("id")
+    if not extractor or not media_id:
+        return None
+    return f"{str(extractor).lower()}:{media_id}"
+
+
+def _find_cached_media(media_id: str | None) -> str | None:
+    """Cache key of a usable entry that already holds media_id."""
+    if not media_id:
+        return None
+    key = _media_alias_index.get(media_id)
+    if not key:
+        return None
+    entry = _cache_index.get(key)
+    if entry and _cache_entry_is_usable(entry):
+        return key
+    return None
+
+
+def _build_ydl_opts(
+    workdir: Path,
+    *,
+    cookiefile: str | None,
+    site: str,
+    fmt: str,
+    photos: bool = False,
+) -> dict[str, Any]:
+    outtmpl = str(workdir / "%(id)s_%(playlist_index)s.%(ext)s")
+    opts = _ytdlp_common_opts(outtmpl=outtmpl, cookiefile=cookiefile)
+    if site == "instagram":
+        opts["noplaylist"] = False
+        opts["playlistend"] = max(1, min(MAX_ITEMS_PER_LINK, 50))
+        if photos:
+            # photo items come without formats (only image URLs); they are fetched by _fetch_photo_entry.
+            # Reels keep the error: a reel without formats is a failed extraction, not a photo.
+            opts["ignore_no_formats_error"] = True
+    else:
+        opts["noplaylist"] = True
+    opts["format"] = fmt
+    opts["merge_output_format"] = MERGE_OUTPUT_FORMAT
+    return opts
+
+
+def _extract_media(url: str, workdir: Path, *, cookiefile: str | None, site: str) -> dict[str, Any]:
+    """Extract metadata (no download) and decide what to download."""
+    wanted_story_id = _extract_ig_story_id(url) if site == "instagram" else None
+    story_user = _extract_ig_story_user(url) if wanted_story_id else None
+    photos = site == "instagram" and _ig_url_may_have_photos(url)
+    cookie_used = True
+    if story_user and IG_STORY_TRAY_TTL_SECONDS > 0:
+        # stories of one user are usually shared in bunches: extract the tray once
+        info, cookie_used = _extract_story_tray(story_user, workdir, cookiefile=cookiefile, site=site)
+        if not _tray_has_entry(info, wanted_story_id):
+            # posted after the tray was cached
+            info, fresh_used = _extract_story_tray(story_user, workdir, cookiefile=cookiefile, site=site, fresh=True)
+            cookie_used = cookie_used or fresh_used
+    else:
+        opts = _build_ydl_opts(workdir, cookiefile=cookiefile, site=site, fmt=VIDEO_FORMAT, photos=photos)
+        with YoutubeDL(opts) as ydl:
+            info = ydl.extract_info(url, download=False)
+
+    # If it's an Instagram story link with explicit id, try to download exactly that story
+    selected_info = info
+    if wanted_story_id:
+        selected_info = _filter_entries_by_id(info, wanted_story_id)
+
+    _check_duration_limit(selected_info)
+
+    # URLs to extract again if the extracted info can no longer be downloaded:
+    # - If we filtered playlist entries to the requested story id, those entry URLs
+    # - Otherwise the original URL
+    targets: list[str] = []
+    if wanted_story_id and isinstance(selected_info, dict) and selected_info.get("entries"):
+        for e in selected_info.get("entries") or []:
+            if not isinstance(e, dict):
+                continue
+            t = e.get("webpage_url") or e.get("url")
+            if isinstance(t, str) and t:
+                targets.append(t)
+
+    if not targets:
+        targets = [url]
+
+    # plain copy of the processed info: downloads pick formats from it without re-extracting
+    plain_info = YoutubeDL.sanitize_info(selected_info)
+    fmt, planned_size = _plan_formats(plain_info)
+
+    title = info.get("title") if isinstance(info, dict) else None
+    return {
+        "title": title,
+        "media_id": _media_identity(selected_info),
+        "info": plain_info,
+        "format": fmt,
+        "targets": targets,
+        "photos": photos,
+        "duration": _total_duration(selected_info),
+        "filesize": planned_size or _estimated_filesize(selected_info),
+        # False: the story tray came from the cache or another link's extraction
+        "cookie_used": cookie_used,
+    }
+
+
+_PHOTO_SUFFIXES = {".jpg", ".jpeg", ".png", ".webp"}
 
-def _extract_ig_story_id(url: str) -> str | None:
-    """Extract numeric story id from an Instagram /stories/<user>/<id>/ URL."""
-    m = re.search(r"/stories/[^/]+/(\d+)", url)
-    return m.group(1) if m else None
+# Shared keep-alive connections for direct photo downloads (used from several download threads)
+_photo_session = requests.Session()
+_photo_session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=max(4, IG_CAROUSEL_PARALLEL * 2)))
+_photo_session.headers["User-Agent"] = "Mozilla/5.0"
 
 
-def _filter_entries_by_id(info: Any, wanted_id: str) -> Any:
-    """If info is a playlist-like dict, keep only entry matching wanted_id (best effort)."""
-    if not wanted_id:
-        return info
-    if not isinstance(info, dict) or not info.get("entries"):
-        return info
+def _is_photo_entry(entry: dict[str, Any]) -> bool:
+    """Image item of a carousel/story: no formats and no duration, only image URLs."""
+    return not entry.get("formats") and not entry.get("duration") and bool(
+        entry.get("thumbnails") or entry.get("thumbnail")
+    )
 
-    entries = list(info.get("entries") or [])
-    filtered: list[dict] = []
-    for e in entries:
-        if not isinstance(e, dict):
-            continue
-        eid = str(e.get("id") or e.get("display_id") or e.get("media_id") or "")
-        if eid == wanted_id:
-            filtered.append(e)
 
-    if not filtered:
-        return info
+def _photo_url(entry: dict[str, Any]) -> str | None:
+    thumbnails = [t for t in entry.get("thumbnails") or [] if isinstance(t, dict) and t.get("url")]
+    if thumbnails:
+        # largest known size; yt-dlp lists thumbnails from worst to best
+        return max(enumerate(thumbnails), key=lambda it: ((it[1].get("width") or 0) * (it[1].get("height") or 0), it[0]))[1]["url"]
+    return entry.get("thumbnail")
 
-    out = dict(info)
-    out["entries"] = filtered
-    return out
 
+def _fetch_photo_entry(entry: dict[str, Any], workdir: Path, stopped: Callable[[], bool]) -> None:
+    """Download a photo entry as <id>_<playlist_index>.<ext>, like yt-dlp's outtmpl would name it."""
+    url = _photo_url(entry)
+    if not url:
+        return
+    suffix = Path(urlsplit(url).path).suffix.lower()
+    if suffix not in _PHOTO_SUFFIXES:
+        suffix = ".jpg"
+    name = re.sub(r"[^\w-]", "_", f"{entry.get('id')}_{entry.get('playlist_index')}")
+    target = workdir / f"{name}{suffix}"
+    tmp = target.with_name(f"{target.name}.part")
+
+    limit = MAX_SIZE_MB * 1024 * 1024
+    size = 0
+    try:
+        with _photo_session.get(
+            url,
+            headers=entry.get("http_headers") or {},
+            timeout=PHOTO_DOWNLOAD_TIMEOUT_SECONDS,
+            stream=True,
+        ) as resp:
+            resp.raise_for_status()
+            with tmp.open("wb") as f:
+                for chunk in resp.iter_content(256 * 1024):
+                    if stopped():
+                        raise DownloadCancelled("Попытка отменена")
+                    size += len(chunk)
+                    if size > limit:
+                        raise MediaPolicyError(f"Фото больше {MAX_SIZE_MB} MB.")
+                    f.write(chunk)
+    except requests.RequestException as e:
+        tmp.unlink(missing_ok=True)
+        # signed image URLs expire: DownloadError makes the caller extract again
+        raise DownloadError(f"Не удалось скачать фото {target.name}: {e}") from e
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+    tmp.replace(target)
+
+
+def _download_entries_concurrently(
+    info: dict[str, Any],
+    workdir: Path,
+    *,
+    cookiefile: str | None,
+    site: str,
+    fmt: str,
+    photos: bool = False,
+    cancel_event: threading.Event | None = None,
+) -> dict[str, dict[str, Any]]:
+    """Download the entries of a playlist-like info in parallel (IG_CAROUSEL_PARALLEL at most).
+
+    Every video entry gets its own YoutubeDL (instances are not thread-safe); photos
+    skip yt-dlp. The first failure stops the other entries at their next chunk.
+    """
+    entries = list(_iter_entries(info))[: max(1, min(MAX_ITEMS_PER_LINK, 50))]
+    if not entries:
+        # e.g. "entries": [None]; an empty pool would raise a ValueError shown to the user
+        raise DownloadError("В публикации нет элементов для скачивания")
+    stop = threading.Event()
+
+    def _stopped() -> bool:
+        return stop.is_set() or (cancel_event is not None and cancel_event.is_set())
+
+    def _stop_if_cancelled(_status: dict[str, Any]) -> None:
+        if _stopped():
+            raise DownloadCancelled("Попытка отменена")
+
+    def _download_entry(index: int, entry: dict[str, Any]) -> dict[str, dict[str, Any]]:
+        _stop_if_cancelled({})
+        # keep %(playlist_index)s in the file name when an entry is processed on its own
+        entry = {
+            **entry,
+            "playlist": entry.get("playlist") or info.get("title") or info.get("id"),
+            "playlist_index": entry.get("playlist_index") or index,
+        }
+        if photos and _is_photo_entry(entry):
+            _fetch_photo_entry(entry, workdir, _stopped)
+            return {}
+        opts = _build_ydl_opts(workdir, cookiefile=cookiefile, site=site, fmt=fmt, photos=photos)
+        opts["progress_hooks"] = [_stop_if_cancelled]
+        with YoutubeDL(opts) as ydl:
+            return _probes_from_ytdlp_result(ydl.process_ie_result(copy.deepcopy(entry), download=True))
+
+    probes: dict[str, dict[str, Any]] = {}
+    with ThreadPoolExecutor(max_workers=min(IG_CAROUSEL_PARALLEL, len(entries)), thread_name_prefix="carousel") as pool:
+        futures = [pool.submit(_download_entry, i, e) for i, e in enumerate(entries, start=1)]
+        done, _ = wait(futures, return_when=FIRST_EXCEPTION)
+        failed = next((f for f in futures if f in done and f.exception() is not None), None)
+        if failed is not None:
+            stop.set()
+            for f in futures:
+                f.cancel()
+            # the first real error, not the cancellations it caused
+            raise failed.exception()
+        for f in futures:
+            probes.update(f.result())
+    return probes
+
+
+def _extract_and_plan(
+    target: str,
+    workdir: Path,
+    *,
+    cookiefile: str | None,
+    site: str,
+    photos: bool,
+) -> tuple[dict[str, Any], str]:
+    """Extract target again and plan its formats the way _extract_media does.
 
+    The planned spec only fits planned info: applied to a fresh, full format list it
+    would pick the best (often oversized) streams.
+    """
+    opts = _build_ydl_opts(workdir, cookiefile=cookiefile, site=site, fmt=VIDEO_FORMAT, photos=photos)
+    with YoutubeDL(opts) as ydl:
+        fresh = YoutubeDL.sanitize_info(ydl.extract_info(target, download=False))
+    fmt, _ = _plan_formats(fresh)
+    return fresh, fmt
 
-def _check_duration_limit(info: Any) -> None:
-    for entry in _iter_entries(info):
-        dur = entry.get("duration")
-        if dur and dur > MAX_DURATION_SEC:
-            raise ValueError(
-                f"Видео слишком длинное: {int(dur)} сек. Максимум: {MAX_DURATION_SEC} сек."
-            )
 
+def _download_extracted(
+    extracted: dict[str, Any],
+    workdir: Path,
+    *,
+    cookiefile: str | None,
+    site: str,
+    fmt: str,
+    cancel_event: threading.Event | None = None,
+) -> dict[str, dict[str, Any]]:
+    """Download the extracted media; returns yt-dlp's stream info of the files it wrote."""
+    info = extracted["info"]
+    photos = bool(extracted.get("photos"))
+    if site == "instagram" and (info.get("entries") or (photos and _is_photo_entry(info))):
+        kwargs = dict(cookiefile=cookiefile, site=site, photos=photos, cancel_event=cancel_event)
+        try:
+            return _download_entries_concurrently(info, workdir, fmt=fmt, **kwargs)
+        except (DownloadError, ReExtractInfo) as e:
+            logger.warning(f"[{site}] Не удалось скачать по извлечённым данным ({e}), извлекаю заново")
+            probes: dict[str, dict[str, Any]] = {}
+            for target in extracted["targets"]:
+                fresh, fresh_fmt = _extract_and_plan(target, workdir, cookiefile=cookiefile, site=site, photos=photos)
+                probes.update(_download_entries_concurrently(fresh, workdir, fmt=fresh_fmt, **kwargs))
+            return probes
+
+    def _download_info(plain_info: dict[str, Any], spec: str) -> dict[str, dict[str, Any]]:
+        opts = _build_ydl_opts(workdir, cookiefile=cookiefile, site=site, fmt=spec, photos=photos)
+        if cancel_event is not None:
+            def _stop_if_cancelled(_status: dict[str, Any]) -> None:
+                if cancel_event.is_set():
+                    raise DownloadCancelled("Попытка отменена")
+
+            opts["progress_hooks"] = [_stop_if_cancelled]
+        with YoutubeDL(opts) as ydl:
+            # formats are selected again for spec from the extracted info; the page is not fetched again
+            return _probes_from_ytdlp_result(ydl.process_ie_result(copy.deepcopy(plain_info), download=True))
 
-def _download_media_with_cookie(url: str, workdir: Path, *, cookiefile: str | None, site: str) -> dict[str, Any]:
-    """Download url into workdir; return cache entry-like dict with files list."""
+    try:
+        return _download_info(info, fmt)
+    except (DownloadError, ReExtractInfo) as e:
+        # format URLs may have expired meanwhile: same fallback as yt-dlp --load-info-json,
+        # but the fresh info is planned again instead of reusing the spec made for the old one
+        logger.warning(f"[{site}] Не удалось скачать по извлечённым данным ({e}), извлекаю заново")
+        probes: dict[str, dict[str, Any]] = {}
+        for target in extracted["targets"]:
+            fresh, fresh_fmt = _extract_and_plan(target, workdir, cookiefile=cookiefile, site=site, photos=photos)
+            probes.update(_download_info(fresh, fresh_fmt))
+        return probes
+
+
+async def _select_downloaded_files(
+    workdir: Path,
+    known_probes: dict[str, dict[str, Any]],
+) -> tuple[list[Path], list[Path], list[Path], dict[str, dict[str, Any] | None]]:
+    """Returns (all files, primary photo/video files, dropped side files, probe per file name)."""
+    all_files = await PROCESS_STAGE.run(_collect_downloaded_files, workdir)
+    probes = await _probe_downloaded_files(all_files, known_probes)
+    selected_files, dropped_files = _select_primary_downloads(all_files, probes)
+    return all_files, selected_files, dropped_files, probes
+
+
+def _remember_extraction(key: str, cookiefile: str | None, extracted: dict[str, Any]) -> None:
+    if METADATA_CACHE_TTL_SECONDS <= 0:
+        return
+    _metadata_cache.pop(key, None)
+    while len(_metadata_cache) >= METADATA_CACHE_MAX_ENTRIES:
+        _metadata_cache.pop(next(iter(_metadata_cache)), None)
+    _metadata_cache[key] = (_now() + METADATA_CACHE_TTL_SECONDS, cookiefile, extracted)
 
-    outtmpl = str(workdir / "%(id)s_%(playlist_index)s.%(ext)s")
-    def _build_opts(fmt: str) -> dict[str, Any]:
-        opts = _ytdlp_common_opts(outtmpl=outtmpl, cookiefile=cookiefile)
-        if site == "instagram":
-            opts["noplaylist"] = False
-            opts["playlistend"] = max(1, min(MAX_ITEMS_PER_LINK, 50))
-        else:
-            opts["noplaylist"] = True
-        opts["format"] = fmt
-        opts["merge_output_format"] = MERGE_OUTPUT_FORMAT
-        return opts
 
-    opts = _build_opts(VIDEO_FORMAT)
-    with YoutubeDL(opts) as ydl:
-        info = ydl.extract_info(url, download=False)
-
-        # If it's an Instagram story link with explicit id, try to download exactly that story
-        selected_info = info
-        wanted_story_id = _extract_ig_story_id(url) if site == "instagram" else None
-        if wanted_story_id:
-            selected_info = _filter_entries_by_id(info, wanted_story_id)
-
-        _check_duration_limit(selected_info)
-
-        # Decide what to download:
-        # - If we filtered playlist entries to the requested story id, download those entry URLs
-        # - Otherwise download the original URL (best effort)
-        targets: list[str] = []
-        if wanted_story_id and isinstance(selected_info, dict) and selected_info.get("entries"):
-            for e in selected_info.get("entries") or []:
-                if not isinstance(e, dict):
-                    continue
-                t = e.get("webpage_url") or e.get("url")
-                if isinstance(t, str) and t:
-                    targets.append(t)
+def _cached_extraction(key: str) -> tuple[str | None, dict[str, Any]] | None:
+    cached = _metadata_cache.get(key)
+    if cached is None:
+        return None
+    if cached[0] <= _now():
+        _metadata_cache.pop(key, None)
+        return None
+    return cached[1], cached[2]
+
+
+def _remember_failure(key: str, category: str, message: str) -> None:
+    if NEGATIVE_CACHE_TTL_SECONDS <= 0:
+        return
+    _negative_cache.pop(key, None)
+    while len(_negative_cache) >= METADATA_CACHE_MAX_ENTRIES:
+        _negative_cache.pop(next(iter(_negative_cache)), None)
+    _negative_cache[key] = (_now() + NEGATIVE_CACHE_TTL_SECONDS, category, message)
 
-        if not targets:
-            targets = [url]
 
-        ydl.download(targets)
+def _raise_if_known_failure(key: str, site: str) -> None:
+    cached = _negative_cache.get(key)
+    if cached is None:
+        return
+    expires_at, category, message = cached
+    if expires_at <= _now():
+        _negative_cache.pop(key, None)
+        return
+    logger.info(f"[{site}] Ссылка недавно не скачалась ({category}), отвечаю из кэша ошибок")
+    if category == "policy":
+        raise MediaPolicyError(message)
+    raise DownloadFailure(message, category)
 
-    all_files = _collect_downloaded_files(workdir)
-    selected_files, dropped_files = _select_primary_downloads(all_files)
 
-    if not selected_files and any(path.suffix.lower() in AUDIO_EXTENSIONS for path in all_files):
+async def _download_media_with_cookie(
+    url: str,
+    workdir: Path,
+    *,
+    cookiefile: str | None,
+    site: str,
+    allow_alias: bool = True,
+    on_extracted=None,
+    cancel_event: threading.Event | None = None,
+    extracted: dict[str, Any] | None = None,
+) -> dict[str, Any]:
+    """Download url into workdir; return cache entry-like dict with files list.
+
+    If the extracted media is already cached under another URL, nothing is downloaded
+    and the result carries "alias_of" with the existing cache key instead of files.
+    on_extracted(extracted) is awaited after extraction, right before the download.
+    A previously extracted dict may be passed to skip extraction; otherwise workdir is
+    emptied by the extraction job itself, so a clean start never waits for a download slot.
+    """
+    if extracted is None:
+        extracted = await EXTRACT_STAGE.run(_extract_in_clean_dir, url, workdir, cookiefile=cookiefile, site=site)
+        _remember_extraction(_cache_key(url), cookiefile, extracted)
+    media_id = extracted["media_id"]
+
+    alias_of = _find_cached_media(media_id) if allow_alias else None
+    if alias_of:
+        logger.info(f"[{site}] Медиа {media_id} уже в кэше, пропускаю скачивание")
+        return {"alias_of": alias_of, "media_id": media_id, "cookie_used": extracted.get("cookie_used", True)}
+
+    if on_extracted is not None:
+        await on_extracted(extracted)
+
+    known_probes = await DOWNLOAD_STAGE.run(
+        _download_extracted,
+        extracted,
+        workdir,
+        cookiefile=cookiefile,
+        site=site,
+        fmt=extracted.get("format") or VIDEO_FORMAT,
+        cancel_event=cancel_event,
+    )
+    all_files, selected_files, dropped_files, probes = await _select_downloaded_files(workdir, known_probes)
+
+    # safety net for formats with misleading metadata: planned downloads already excluded audio-only results
+    if (
+        not selected_files
+        and extracted.get("format", VIDEO_FORMAT) == VIDEO_FORMAT
+        and any(path.suffix.lower() in AUDIO_EXTENSIONS for path in all_files)
+    ):
         logger.warning(
             "[%s] После скачивания остались только аудиофайлы (%s). Повторяю с fallback format.",
             site,
             ", ".join(path.name for path in all_files),
         )
-        _cleanup_tmp_dir(workdir)
-        fallback_opts = _build_opts(VIDEO_FORMAT_FALLBACK)
-        with YoutubeDL(fallback_opts) as ydl:
-            ydl.download(targets)
-        all_files = _collect_downloaded_files(workdir)
-        selected_files, dropped_files = _select_primary_downloads(all_files)
+        await DOWNLOAD_STAGE.run(_cleanup_tmp_dir, workdir)
+        known_probes = await DOWNLOAD_STAGE.run(
+            _download_extracted,
+            extracted,
+            workdir,
+            cookiefile=cookiefile,
+            site=site,
+            fmt=VIDEO_FORMAT_FALLBACK,
+            cancel_event=cancel_event,
+        )
+        all_files, selected_files, dropped_files, probes = await _select_downloaded_files(workdir, known_probes)
 
     if not all_files:
         raise FileNotFoundError("Не удалось найти скачанные файлы после загрузки.")
@@ -860,71 +3139,397 @@ def _download_media_with_cookie(url: str, workdir: Path, *, cookiefile: str | No
             ", ".join(path.name for path in dropped_files),
         )
 
-    selected_files = _normalize_downloaded_files(selected_files)
-
-    title = None
-    try:
-        if isinstance(info, dict):
-            title = info.get("title")
-    except Exception:
-        title = None
-
     return {
-        "title": title,
+        "title": extracted["title"],
+        "media_id": media_id,
         "files": [str(p) for p in selected_files],
+        # probed once here; normalization reuses it instead of running ffprobe again
+        "probes": {p.name: probes.get(p.name) for p in selected_files},
+        "cookie_used": extracted.get("cookie_used", True),
     }
 
 
-def download_media_with_fallback(
+async def _attempt_download(
+    url: str,
+    workdir: Path,
+    *,
+    site: str,
+    cookiefile: str | None,
+    label: str,
+    allow_alias: bool,
+    on_extracted,
+    cancel_event: threading.Event | None = None,
+) -> dict[str, Any]:
+    """One cookie attempt in workdir; records the outcome in the cookie's health."""
+    started = time.monotonic()
+    extracted_after: float | None = None
+
+    async def _on_extracted(extracted: dict[str, Any]) -> None:
+        # latency is measured up to extraction: lane waits and big downloads are not the cookie's fault
+        nonlocal extracted_after
+        extracted_after = time.monotonic() - started
+        if on_extracted is not None:
+            await on_extracted(extracted)
+
+    logger.info(f"[{site}] Попытка {label} скачать URL. cookies={'нет' if not cookiefile else cookiefile}")
+    try:
+        result = await _download_media_with_cookie(
+            url,
+            workdir,
+            cookiefile=cookiefile,
+            site=site,
+            allow_alias=allow_alias,
+            on_extracted=_on_extracted,
+            cancel_event=cancel_event,
+        )
+    except (QueueFullError, MediaPolicyError):
+        _release_cookie_probes(site, [cookiefile])
+        raise
+    except Exception as e:
+        category = classify_download_error(e, downloading=extracted_after is not None)
+        _download_error_counts[(site, category)] += 1
+        logger.warning(f"[{site}] Ошибка скачивания ({category}): {e}")
+        if category == "rate_limited":
+            _drain_cookie_budget(cookiefile)
+        if isinstance(e, DownloadError) and category in {"auth", "rate_limited", "unknown"}:
+            _record_cookie_result(site, cookiefile, ok=False, error=str(e))
+        else:
+            # removed media, network trouble, disk errors, ...: says nothing about the cookie
+            _release_cookie_probes(site, [cookiefile])
+        raise DownloadFailure(str(e), category) from e
+    except BaseException:
+        _release_cookie_probes(site, [cookiefile])
+        raise
+
+    if not result.get("cookie_used", True):
+        # a shared story tray: the cookie made no request, so it earns no credit and costs no budget
+        _release_cookie_probes(site, [cookiefile])
+        _refund_cookie_account(cookiefile)
+        return result
+    latency = extracted_after if extracted_after is not None else time.monotonic() - started
+    _record_cookie_result(site, cookiefile, ok=True, latency=latency)
+    return result
+
+
+async def _download_sequential(
+    url: str,
+    tmp_dir: Path,
+    site: str,
+    attempts: list[str | None],
+    *,
+    allow_alias: bool,
+    on_extracted,
+) -> tuple[dict[str, Any] | None, Exception | None]:
+    last_err: Exception | None = None
+    tried = 0
+    try:
+        for idx, cookiefile in enumerate(attempts, start=1):
+            tried = idx
+            # charged before any await, so concurrent requests pick different accounts
+            _use_cookie_account(cookiefile)
+            try:
+                result = await _attempt_download(
+                    url,
+                    tmp_dir,
+                    site=site,
+                    cookiefile=cookiefile,
+                    label=f"{idx}/{len(attempts)}",
+                    allow_alias=allow_alias,
+                    on_extracted=on_extracted,
+                )
+                return result, None
+            except DownloadFailure as e:
+                last_err = e
+                if e.category in STOP_ERROR_CATEGORIES:
+                    break
+        return None, last_err
+    finally:
+        # half-open retries reserved for attempts we never reached
+        _release_cookie_probes(site, attempts[tried:])
+
+
+async def _download_hedged(
+    url: str,
+    tmp_dir: Path,
+    site: str,
+    attempts: list[str | None],
+    *,
+    allow_alias: bool,
+    on_extracted,
+) -> tuple[dict[str, Any] | None, Exception | None]:
+    """Race cookie attempts instead of waiting for each one to fail.
+
+    If the newest attempt has not finished extraction within HEDGE_DELAY_SECONDS,
+    the next one starts in parallel in its own work dir (at most HEDGE_MAX_PARALLEL
+    at once). The first attempt to finish extraction cancels the others; if it fails
+    later, the remaining attempts go on. yt-dlp cannot be interrupted mid-extraction,
+    so a cancelled thread finishes extracting and is stopped before downloading.
+    """
+    loop = asyncio.get_running_loop()
+    running: dict[asyncio.Task, threading.Event] = {}
+    # attempts run in their own tasks, but lane admission (on_extracted) must run in
+    # this one: it sets _current_lane for the rest of the handler
+    admissions: asyncio.Queue[tuple[dict[str, Any], asyncio.Future]] = asyncio.Queue()
+    admission_wait = asyncio.ensure_future(admissions.get())
+    winner: asyncio.Task | None = None
+    last_err: Exception | None = None
+    launched = 0
+    last_launch = 0.0
+
+    def _cancel_others(keep: asyncio.Task) -> None:
+        for task, cancel_event in running.items():
+            if task is not keep:
+                cancel_event.set()
+                task.cancel()
+
+    def _launch() -> None:
+        nonlocal launched, last_launch
+        cookiefile = attempts[launched]
+        launched += 1
+        last_launch = loop.time()
+        _use_cookie_account(cookiefile)
+        cancel_event = threading.Event()
+        holder: list[asyncio.Task] = []
+
+        async def _on_extracted(extracted: dict[str, Any]) -> None:
+            nonlocal winner
+            task = holder[0]
+            if winner is not None and winner is not task:
+                raise asyncio.CancelledError()
+            winner = task
+            _cancel_others(task)
+            proceed = loop.create_future()
+            admissions.put_nowait((extracted, proceed))
+            _current_lane.set(await proceed)
+
+        task = asyncio.create_task(
+            _attempt_download(
+                url,
+                tmp_dir / f"attempt_{launched}",
+                site=site,
+                cookiefile=cookiefile,
+                label=f"{launched}/{len(attempts)}",
+                allow_alias=allow_alias,
+                on_extracted=_on_extracted,
+                cancel_event=cancel_event,
+            )
+        )
+        holder.append(task)
+        running[task] = cancel_event
+
+    try:
+        while True:
+            if not running:
+                if launched >= len(attempts):
+                    return None, last_err
+                _launch()
+
+            timeout = None
+            if winner is None and launched < len(attempts) and len(running) < HEDGE_MAX_PARALLEL:
+                timeout = max(0.0, last_launch + HEDGE_DELAY_SECONDS - loop.time())
+            done, _ = await asyncio.wait(
+                set(running) | {admission_wait},
+                timeout=timeout,
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+            if not done:
+                logger.info(f"[{site}] Попытка не уложилась в {HEDGE_DELAY_SECONDS} с, запускаю следующую параллельно")
+                _launch()
+                continue
+
+            if admission_wait in done:
+                extracted, proceed = admission_wait.result()
+                admission_wait = asyncio.ensure_future(admissions.get())
+                try:
+                    if on_extracted is not None:
+                        await on_extracted(extracted)
+                except BaseException:
+                    proceed.cancel()
+                    raise
+                if not proceed.done():
+                    proceed.set_result(_current_lane.get())
+
+            for task in done:
+                if task not in running:
+                    continue
+                running.pop(task)
+                if task is winner:
+                    winner = None
+                if task.cancelled():
+                    continue
+                exc = task.exception()
+                if exc is None:
+                    return task.result(), None
+                if not isinstance(exc, DownloadFailure):
+                    raise exc
+                last_err = exc
+                if exc.category in STOP_ERROR_CATEGORIES:
+                    return None, last_err
+                # a failed attempt frees its place right away, as in the sequential loop
+                if winner is None and launched < len(attempts) and len(running) < HEDGE_MAX_PARALLEL:
+                    _launch()
+    finally:
+        admission_wait.cancel()
+        for task, cancel_event in running.items():
+            cancel_event.set()
+            task.cancel()
+        if running:
+            await asyncio.gather(*running, return_exceptions=True)
+        # half-open retries reserved for attempts we never reached
+        _release_cookie_probes(site, attempts[launched:])
+
+
+async def download_media_with_fallback(
     url: str,
     tmp_dir: Path,
     site: str,
     preferred_user_id: int | None = None,
+    allow_alias: bool = True,
+    on_extracted=None,
 ) -> dict[str, Any]:
     """Try to download using no cookies (optional) and then multiple cookie files."""
-    cookie_files = _cookie_files_for_site(site, preferred_user_id=preferred_user_id)
+    key = _cache_key(url)
+    _raise_if_known_failure(key, site)
+
+    result = await _download_with_cached_extraction(
+        url, tmp_dir, site, key, allow_alias=allow_alias, on_extracted=on_extracted
+    )
+    if result is None:
+        result = await _download_with_cookie_attempts(
+            url, tmp_dir, site, key, preferred_user_id, allow_alias=allow_alias, on_extracted=on_extracted
+        )
+    if result.get("files"):
+        files = [Path(p) for p in result["files"]]
+        normalized = await _normalize_downloaded_files(files, result.get("probes"))
+        result["files"] = [str(p) for p in normalized]
+    return result
+
+
+async def _download_with_cached_extraction(
+    url: str,
+    tmp_dir: Path,
+    site: str,
+    key: str,
+    *,
+    allow_alias: bool,
+    on_extracted,
+) -> dict[str, Any] | None:
+    """Download from a recent extraction of the same link, if any. None: extract from scratch."""
+    cached = _cached_extraction(key)
+    if cached is None:
+        return None
+    cookiefile, extracted = cached
+    logger.info(f"[{site}] Использую недавние метаданные ссылки. cookies={'нет' if not cookiefile else cookiefile}")
+    # a quick directory operation: it must not queue behind downloads for a stage slot
+    await asyncio.to_thread(_reset_dir, tmp_dir)
+    try:
+        return await _download_media_with_cookie(
+            url,
+            tmp_dir,
+            cookiefile=cookiefile,
+            site=site,
+            allow_alias=allow_alias,
+            on_extracted=on_extracted,
+            extracted=extracted,
+        )
+    except (QueueFullError, MediaPolicyError):
+        raise
+    except Exception as e:
+        logger.warning(f"[{site}] Не удалось скачать по недавним метаданным, извлекаю заново: {e}")
+        _metadata_cache.pop(key, None)
+        return None
+
+
+async def _download_with_cookie_attempts(
+    url: str,
+    tmp_dir: Path,
+    site: str,
+    key: str,
+    preferred_user_id: int | None,
+    *,
+    allow_alias: bool,
+    on_extracted,
+) -> dict[str, Any]:
+    # a cheap, mtime-cached listing: it must not queue behind extractions for a stage slot
+    cookie_files = await asyncio.to_thread(_cookie_files_for_site, site, preferred_user_id=preferred_user_id)
 
     attempts: list[str | None] = []
     if TRY_NO_COOKIES_FIRST:
         attempts.append(None)
     attempts.extend(cookie_files)
+    preferred = None
+    if site == "instagram" and preferred_user_id:
+        preferred = str(_uploaded_ig_cookie_path_for_user(preferred_user_id))
+    attempts = _order_cookie_attempts(site, attempts, preferred)
 
-    last_err: Exception | None = None
-    last_err_text: str | None = None
+    download = _download_hedged if HEDGE_ENABLED and len(attempts) > 1 else _download_sequential
+    try:
+        result, last_err = await download(
+            url, tmp_dir, site, attempts, allow_alias=allow_alias, on_extracted=on_extracted
+        )
+    except MediaPolicyError as e:
+        _remember_failure(key, "policy", str(e))
+        raise
+
+    if result is None:
+        if last_err is None:
+            raise DownloadFailure("Не удалось скачать медиа.", "unknown")
+        if last_err.category in STOP_ERROR_CATEGORIES:
+            logger.info(f"[{site}] Прекращаю попытки: ошибка типа {last_err.category}")
+            # a short link still here did not resolve (e.g. a network blip): yt-dlp's
+            # "Unsupported URL" for it says nothing about the post itself
+            if not _is_short_link(url):
+                _remember_failure(key, last_err.category, str(last_err))
+        raise last_err
+    return result
+
+
+def _store_downloaded_files(files: list[Path], cache_dir: Path) -> list[dict[str, Any]]:
+    """Move downloaded files into cache_dir and return cache items for them."""
+    cache_dir.mkdir(parents=True, exist_ok=True)
+
+    items: list[dict[str, Any]] = []
+    for p in files:
+        kind = _classify_file(p)
+        target = cache_dir / p.name
+        if target.exists():
+            # avoid collisions
+            target = cache_dir / f"{p.stem}_{int(_now())}{p.suffix}"
+        shutil.move(str(p), str(target))
+        items.append({
+            "kind": kind,
+            "local_filename": target.name,
+            "size_bytes": target.stat().st_size,
+            "tg_file_id": None,
+        })
+    return items
 
-    for idx, cookiefile in enumerate(attempts, start=1):
-        # Ensure temp directory is clean between attempts
-        try:
-            for p in tmp_dir.glob("*"):
-                if p.is_file() or p.is_symlink():
-                    p.unlink(missing_ok=True)
-                elif p.is_dir():
-                    shutil.rmtree(p, ignore_errors=True)
-        except Exception:
-            pass
-        try:
-            logger.info(
-                f"[{site}] Попытка {idx}/{len(attempts)} скачать URL. cookies={'нет' if not cookiefile else cookiefile}"
-            )
-            return _download_media_with_cookie(url, tmp_dir, cookiefile=cookiefile, site=site)
-        except DownloadError as e:
-            last_err = e
-            last_err_text = str(e)
-            logger.warning(f"[{site}] yt-dlp DownloadError: {e}")
-        except Exception as e:
-            last_err = e
-            last_err_text = str(e)
-            logger.warning(f"[{site}] Ошибка скачивания: {e}")
 
-    raise RuntimeError(last_err_text or "Не удалось скачать медиа.") from last_err
+def _write_cache_entry(entry: dict[str, Any]) -> None:
+    """Index entry now; its DB row is written by clean_cache_job (no disk I/O on the event loop)."""
+    _register_cache_entry(entry)
+    _cache_dirty_keys.add(str(entry["key"]))
 
 
-def _write_cache_entry(entry: dict[str, Any]) -> None:
-    key = str(entry["key"])
-    d = _cache_dir_for_key(key)
-    d.mkdir(parents=True, exist_ok=True)
-    _meta_path_for_key(key).write_text(json.dumps(entry, ensure_ascii=False, indent=2), encoding="utf-8")
-    _cache_index[key] = entry
+def _add_cache_alias(entry: dict[str, Any], alias_key: str) -> None:
+    """Make alias_key (another URL key) resolve to an existing entry."""
+    if alias_key == entry.get("key"):
+        return
+    aliases = entry.setdefault("aliases", [])
+    if alias_key not in aliases:
+        aliases.append(alias_key)
+        _write_cache_entry(entry)
+
+
+def _upload_source(path: Path, stack: ExitStack) -> Any:
+    """What to pass to the Bot API for a local file.
+
+    A local-mode server reads the file itself (the Path becomes a file:// URI), so nothing
+    is streamed through the bot; otherwise the file is uploaded as multipart data.
+    """
+    if TELEGRAM_LOCAL_MODE:
+        return path.absolute()
+    return InputFile(stack.enter_context(path.open("rb")), filename=path.name)
 
 
 async def _send_single_item(
@@ -957,7 +3562,8 @@ async def _send_single_item(
 
     # Otherwise send local file
     assert media_path is not None
-    with media_path.open("rb") as f:
+    with ExitStack() as stack:
+        f = _upload_source(media_path, stack)
         if kind == "photo":
             msg = await update.message.reply_photo(photo=f, caption=caption, parse_mode=parse_mode)
             return msg.photo[-1].file_id
@@ -1052,8 +3658,7 @@ async def _send_media_group(
                 if not path.exists() or not path.is_file():
                     raise FileNotFoundError(f"Missing media file: {path}")
 
-                fp = stack.enter_context(path.open("rb"))
-                input_file = InputFile(fp, filename=path.name)
+                input_file = _upload_source(path, stack)
 
                 if kind == "photo":
                     media_group.append(InputMediaPhoto(media=input_file, caption=_cap(i), parse_mode=_pm(i)))
@@ -1090,10 +3695,36 @@ async def _send_media_group(
     return out
 
 
+def _refresh_file_id_tier(entry: dict[str, Any]) -> bool:
+    """Start the long-lived file_id tier once every item has a Telegram file_id."""
+    if _entry_has_all_file_ids(entry) and _entry_file_ids_expired(entry):
+        entry["file_ids_expire_at"] = _now() + float(CACHE_FILE_ID_TTL_SECONDS)
+        return True
+    return False
+
+
 async def send_cache_entry(update: Update, context: ContextTypes.DEFAULT_TYPE, entry: dict[str, Any]) -> None:
-    """Send cached media and update cached Telegram file_ids."""
+    """Send cached media and update cached Telegram file_ids.
+
+    Sends that only reuse file_ids bypass the upload stage; uploads of local files wait for a slot.
+    """
+    if _entry_has_all_file_ids(entry):
+        await _send_cache_items(update, context, entry)
+        return
+    # a big upload (local Bot API mode) can outlast CACHE_TTL_SECONDS and the slot wait adds up
     key = str(entry["key"])
-    d = _cache_dir_for_key(key)
+    _cache_pins[key] += 1
+    try:
+        async with UPLOAD_STAGE.slot():
+            await _send_cache_items(update, context, entry)
+    finally:
+        _cache_pins[key] -= 1
+        if _cache_pins[key] <= 0:
+            del _cache_pins[key]
+
+
+async def _send_cache_items(update: Update, context: ContextTypes.DEFAULT_TYPE, entry: dict[str, Any]) -> None:
+    d = _cache_dir_for_entry(entry)
     items = entry.get("items") or []
 
     # Build normalized items for sending
@@ -1118,14 +3749,18 @@ async def send_cache_entry(update: Update, context: ContextTypes.DEFAULT_TYPE, e
 
     if all_album_ok and 1 < len(send_items) <= 10:
         file_ids = await _send_media_group(update, context, items=send_items, caption=caption)
-        # Update file_ids
+        # Store new file_ids (known ones stay valid, so a pure cache hit writes nothing)
+        changed = False
         for i, fid in enumerate(file_ids):
-            if fid:
+            if fid and not items[i].get("tg_file_id"):
                 items[i]["tg_file_id"] = fid
-        _write_cache_entry(entry)
+                changed = True
+        if _refresh_file_id_tier(entry) or changed:
+            _write_cache_entry(entry)
         return
 
     # Otherwise send one by one
+    changed = False
     for i, it in enumerate(send_items):
         kind = it["kind"]
         tg_file_id = it.get("tg_file_id")
@@ -1137,10 +3772,12 @@ async def send_cache_entry(update: Update, context: ContextTypes.DEFAULT_TYPE, e
         else:
             fid = await _send_single_item(update, context, kind=kind, media=Path(abs_path), caption=caption if i == 0 else None)
 
-        if fid:
+        if fid and not tg_file_id:
             items[i]["tg_file_id"] = fid
+            changed = True
 
-    _write_cache_entry(entry)
+    if _refresh_file_id_tier(entry) or changed:
+        _write_cache_entry(entry)
 
 
 # -------------------------
@@ -1284,16 +3921,41 @@ async def get_users_count(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         await update.message.reply_text("❌ У вас нет прав на выполнение этой команды.")
         return
 
-    try:
-        if not USERS_FILE.exists():
-            users_count = 0
-        else:
-            users_count = len(USERS_FILE.read_text(encoding="utf-8").splitlines())
+    await update.message.reply_text(f"👥 Всего пользователей: {len(_known_users)}")
 
-        await update.message.reply_text(f"👥 Всего пользователей: {users_count}")
-    except Exception as e:
-        logger.error(f"Ошибка получения количества пользователей: {e}")
-        await update.message.reply_text("⚠ Ошибка при подсчёте пользователей.")
+
+async def cookies_status_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if ADMIN_ID and update.message.chat_id != ADMIN_ID:
+        await update.message.reply_text("❌ У вас нет прав на выполнение этой команды.")
+        return
+
+    if not _cookie_health and not _download_error_counts:
+        await update.message.reply_text("Статистики по cookies пока нет.")
+        return
+
+    now = _now()
+    marks = {"ok": "✅", "half-open": "🟡", "open": "❌"}
+    lines: list[str] = []
+    for (site, cookie), health in sorted(_cookie_health.items()):
+        state = health.state(now)
+        line = (
+            f"{marks[state]} [{site}] {Path(cookie).name if cookie else 'без cookies'}: "
+            f"успех {health.success_rate:.0%}, {health.latency:.1f} с, "
+            f"{health.successes} ок / {health.failures} ошибок"
+        )
+        if state == "open":
+            line += f", отключены ещё {int(health.open_until - now)} с"
+        if state != "ok" and health.last_error:
+            line += f"\n    {health.last_error[:120]}"
+        lines.append(line)
+
+    if _download_error_counts:
+        lines.append("\nОшибки скачивания по типам:")
+        for (site, category), count in sorted(_download_error_counts.items()):
+            lines.append(f"[{site}] {category}: {count}")
+
+    text = "🍪 Состояние cookies:\n" + "\n".join(lines)
+    await update.message.reply_text(text[:4000])
 
 
 async def pechenyuha_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -1356,6 +4018,7 @@ async def handle_cookie_document(update: Update, context: ContextTypes.DEFAULT_T
             return
 
         os.replace(tmp_path, final_path)
+        _reset_cookie_health(str(final_path))
         context.user_data.pop(EXPECTING_IG_COOKIE_KEY, None)
 
         pool_size = len(_list_uploaded_ig_cookie_files())
@@ -1378,6 +4041,161 @@ def _looks_like_supported_video_url(text: str) -> bool:
     return bool(INSTAGRAM_RE.match(text) or TIKTOK_RE.match(text) or YOUTUBE_RE.match(text) or VK_RE.match(text))
 
 
+def _lane_for_media(extracted: dict[str, Any]) -> FairScheduler:
+    duration = float(extracted.get("duration") or 0)
+    filesize = int(extracted.get("filesize") or 0)
+    if duration > FAST_LANE_MAX_DURATION_SEC or filesize > FAST_LANE_MAX_FILESIZE_MB * 1024 * 1024:
+        return HEAVY_LANE
+    return FAST_LANE
+
+
+@contextlib.asynccontextmanager
+async def _queue_slot(scheduler: FairScheduler, update: Update, chat_id: int):
+    """Hold a scheduler slot; tell the user their queue position while they wait."""
+    notice = None
+
+    async def _notify(position: int) -> None:
+        nonlocal notice
+        try:
+            notice = await update.message.reply_text(
+                f"⏳ Ты в очереди: {position}. Начну, как только освободится место."
+            )
+        except Exception as e:
+            logger.warning(f"Не удалось отправить позицию в очереди: {e}")
+
+    async with scheduler.slot(chat_id, on_queued=_notify):
+        if notice is not None:
+            try:
+                await notice.delete()
+            except Exception:
+                pass
+        yield
+
+
+@contextlib.asynccontextmanager
+async def _lane_slot(lane: FairScheduler, update: Update, chat_id: int):
+    """Hold a lane slot (see _queue_slot) and mark the rest of the job with the lane."""
+    async with _queue_slot(lane, update, chat_id):
+        token = _current_lane.set(lane.name)
+        try:
+            yield
+        finally:
+            _current_lane.reset(token)
+
+
+async def _reject_if_over_quota(update: Update, chat_id: int, requester_id: int | None) -> bool:
+    wait = _take_request_quota(chat_id, requester_id)
+    if not wait:
+        return False
+    await update.message.reply_text(f"Слишком много запросов. Попробуй через {int(wait) + 1} сек.")
+    return True
+
+
+async def _reply_if_known_failure(update: Update, key: str, site: str) -> bool:
+    """Answer a recently failed link from the negative cache: no quota, queue or network."""
+    try:
+        _raise_if_known_failure(key, site)
+    except MediaPolicyError as e:
+        await update.message.reply_text(str(e))
+        return True
+    except DownloadFailure as e:
+        await update.message.reply_text(DOWNLOAD_FAILURE_TEXTS.get(e.category, DOWNLOAD_FAILURE_DEFAULT_TEXT))
+        return True
+    return False
+
+
+async def _download_to_cache_and_send(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    *,
+    url: str,
+    site: str,
+    key: str,
+    chat_id: int,
+    requester_id: int | None,
+) -> None:
+    # every attempt empties tmp_dir before it writes there
+    tmp_dir = WORK_DIR / f"dl_{key[:12]}"
+    extract_stack = contextlib.AsyncExitStack()
+    lane_stack = contextlib.AsyncExitStack()
+    admitted = False
+
+    async def _admit(extracted: dict[str, Any]) -> None:
+        # the lane is known only after extraction; keep the slot across cookie attempts
+        nonlocal admitted
+        if admitted:
+            return
+        # give the chat's extraction turn to the next chat before queueing for a lane
+        await extract_stack.aclose()
+        await lane_stack.enter_async_context(_lane_slot(_lane_for_media(extracted), update, chat_id))
+        admitted = True
+
+    try:
+        await extract_stack.enter_async_context(_queue_slot(EXTRACT_ADMISSION, update, chat_id))
+        result = await download_media_with_fallback(url, tmp_dir, site, requester_id, on_extracted=_admit)
+
+        alias_entry = _cache_index.get(result.get("alias_of") or "")
+        if alias_entry and _cache_entry_is_usable(alias_entry):
+            _touch_cache_entry(alias_entry)
+            _add_cache_alias(alias_entry, key)
+            # the send may be a full upload: do not hold the chat's extraction turn through it
+            await extract_stack.aclose()
+            await send_cache_entry(update, context, alias_entry)
+            return
+        if result.get("alias_of"):
+            # the aliased entry expired meanwhile: download for real
+            result = await download_media_with_fallback(
+                url,
+                tmp_dir,
+                site,
+                requester_id,
+                False,
+                on_extracted=_admit,
+            )
+
+        files = [Path(p) for p in result["files"]]
+        # Apply MAX_ITEMS_PER_LINK also post-download (safety)
+        files = files[:max(1, min(MAX_ITEMS_PER_LINK, 10_000))]
+
+        # every download gets its own directory, so a purge queued for an
+        # older entry with the same key never touches these files
+        cache_dir_name = f"{key}_{int(_now() * 1000)}"
+        items = await PROCESS_STAGE.run(_store_downloaded_files, files, CACHE_DIR / cache_dir_name)
+
+        entry = {
+            "key": key,
+            "dir": cache_dir_name,
+            "url": url,
+            "site": site,
+            "title": result.get("title"),
+            "media_id": result.get("media_id"),
+            "created_at": _now(),
+            "expires_at": _now() + float(CACHE_TTL_SECONDS),
+            "size_bytes": sum(int(it.get("size_bytes") or 0) for it in items),
+            "hits": 0,
+            "items": items,
+        }
+        _write_cache_entry(entry)
+
+        await send_cache_entry(update, context, entry)
+
+    except QueueFullError:
+        _refund_request_quota(chat_id, requester_id)
+        await update.message.reply_text(QUEUE_FULL_TEXT)
+    except ValueError as e:
+        await update.message.reply_text(str(e))
+    except Exception as e:
+        logger.error(f"Ошибка: {e}")
+        category = classify_download_error(e)
+        await update.message.reply_text(DOWNLOAD_FAILURE_TEXTS.get(category, DOWNLOAD_FAILURE_DEFAULT_TEXT))
+        _purge_cache_entry(key)
+    finally:
+        await extract_stack.aclose()
+        await lane_stack.aclose()
+        # without a download slot: a finished job must not hold the URL lock while downloads run
+        await asyncio.to_thread(shutil.rmtree, tmp_dir, ignore_errors=True)
+
+
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обрабатывает сообщения, сохраняет chat_id и загружает видео/медиа или музыку."""
     if update.message is None or update.message.text is None:
@@ -1389,154 +4207,135 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
     save_user(chat_id)
 
-    # Cleanup cache opportunistically (cheap)
-    try:
-        cleanup_cache()
-    except Exception:
-        pass
-
-    async with sema:
-        # 1) Yandex Music by URL
-        if YANDEX_URL_RE.search(text):
-            audio_filename = None
-            try:
-                audio_filename = await asyncio.to_thread(download_audio_by_url, text)
+    # 1) Yandex Music by URL
+    if YANDEX_URL_RE.search(text):
+        if await _reject_if_over_quota(update, chat_id, requester_id):
+            return
+        audio_filename = None
+        try:
+            async with _lane_slot(HEAVY_LANE, update, chat_id):
+                audio_filename = await DOWNLOAD_STAGE.run(download_audio_by_url, text)
                 from os.path import basename, splitext
 
-                with open(audio_filename, "rb") as audio_file:
-                    await update.message.reply_audio(
-                        audio=audio_file,
-                        title=splitext(basename(audio_filename))[0],
-                    )
+                async with UPLOAD_STAGE.slot():
+                    with open(audio_filename, "rb") as audio_file:
+                        await update.message.reply_audio(
+                            audio=audio_file,
+                            title=splitext(basename(audio_filename))[0],
+                        )
+        except QueueFullError:
+            _refund_request_quota(chat_id, requester_id)
+            await update.message.reply_text(QUEUE_FULL_TEXT)
+        except Exception as e:
+            logger.error(f"Ошибка: {e}")
+            await update.message.reply_text("Не удалось загрузить музыку.")
+        finally:
+            if audio_filename and os.path.exists(audio_filename):
+                try:
+                    os.remove(audio_filename)
+                except Exception:
+                    pass
+        return
+
+    # 2) Supported video/media URLs only
+    if _looks_like_supported_video_url(text):
+        url = _strip_tracking_params(text)
+        if _is_short_link(url):
+            url = await _resolve_short_link(url)
+        site = _site_for_url(url)
+        key = _cache_key(url)
+
+        # If cached - send immediately
+        entry = _cache_index.get(key)
+        if entry and _cache_entry_is_usable(entry):
+            try:
+                _touch_cache_entry(entry)
+                await send_cache_entry(update, context, entry)
+                return
             except Exception as e:
-                logger.error(f"Ошибка: {e}")
-                await update.message.reply_text("Не удалось загрузить музыку.")
-            finally:
-                if audio_filename and os.path.exists(audio_filename):
-                    try:
-                        os.remove(audio_filename)
-                    except Exception:
-                        pass
+                logger.warning(f"Кэш найден, но отправка не удалась (будет перезакачка): {e}")
+                _purge_cache_entry(key)
+
+        if await _reply_if_known_failure(update, key, site):
             return
 
-        # 2) Supported video/media URLs only
-        if _looks_like_supported_video_url(text):
-            url = text
-            site = _site_for_url(url)
-            key = _cache_key(url)
+        if await _reject_if_over_quota(update, chat_id, requester_id):
+            return
 
-            # If cached - send immediately
+        lock = _get_or_create_lock(key)
+        async with lock:
+            # re-check after lock
             entry = _cache_index.get(key)
             if entry and _cache_entry_is_usable(entry):
-                try:
-                    await send_cache_entry(update, context, entry)
-                    return
-                except Exception as e:
-                    logger.warning(f"Кэш найден, но отправка не удалась (будет перезакачка): {e}")
-                    _purge_cache_entry(key)
-
-            lock = _get_or_create_lock(key)
-            async with lock:
-                # re-check after lock
-                entry = _cache_index.get(key)
-                if entry and _cache_entry_is_usable(entry):
-                    await send_cache_entry(update, context, entry)
-                    return
-
-                tmp_dir = Path("/tmp") / f"dl_{key[:12]}"
-                if tmp_dir.exists():
-                    shutil.rmtree(tmp_dir, ignore_errors=True)
-                tmp_dir.mkdir(parents=True, exist_ok=True)
+                _touch_cache_entry(entry)
+                await send_cache_entry(update, context, entry)
+                return
+            # the job that held the lock may have just failed on this link
+            if await _reply_if_known_failure(update, key, site):
+                return
+
+            await _download_to_cache_and_send(
+                update,
+                context,
+                url=url,
+                site=site,
+                key=key,
+                chat_id=chat_id,
+                requester_id=requester_id,
+            )
+        return
 
-                try:
-                    result = await asyncio.to_thread(
-                        download_media_with_fallback,
-                        url,
-                        tmp_dir,
-                        site,
-                        requester_id,
-                    )
-
-                    files = [Path(p) for p in result["files"]]
-                    # Apply MAX_ITEMS_PER_LINK also post-download (safety)
-                    files = files[:max(1, min(MAX_ITEMS_PER_LINK, 10_000))]
-
-                    cache_dir = _cache_dir_for_key(key)
-                    cache_dir.mkdir(parents=True, exist_ok=True)
-
-                    items: list[dict[str, Any]] = []
-                    for p in files:
-                        kind = _classify_file(p)
-                        # Put into cache folder
-                        target = cache_dir / p.name
-                        if target.exists():
-                            # avoid collisions
-                            target = cache_dir / f"{p.stem}_{int(_now())}{p.suffix}"
-                        shutil.move(str(p), str(target))
-                        items.append({
-                            "kind": kind,
-                            "local_filename": target.name,
-                            "tg_file_id": None,
-                        })
-
-                    entry = {
-                        "key": key,
-                        "url": url,
-                        "site": site,
-                        "title": result.get("title"),
-                        "created_at": _now(),
-                        "expires_at": _now() + float(CACHE_TTL_SECONDS),
-                        "items": items,
-                    }
-                    _write_cache_entry(entry)
-
-                    await send_cache_entry(update, context, entry)
-
-                except ValueError as e:
-                    await update.message.reply_text(str(e))
-                except Exception as e:
-                    logger.error(f"Ошибка: {e}")
-                    await update.message.reply_text(
-                        "Не удалось загрузить. Возможно пора обновить cookies"
-                    )
-                    _purge_cache_entry(key)
-                finally:
-                    try:
-                        shutil.rmtree(tmp_dir, ignore_errors=True)
-                    except Exception:
-                        pass
+    # 3) Music by query
+    if MUSIC_PATTERN.match(text):
+        if await _reject_if_over_quota(update, chat_id, requester_id):
             return
+        audio_filename = None
+        try:
+            async with _lane_slot(HEAVY_LANE, update, chat_id):
+                audio_filename = await DOWNLOAD_STAGE.run(download_music, text)
+                async with UPLOAD_STAGE.slot():
+                    with open(audio_filename, "rb") as audio_file:
+                        await update.message.reply_audio(audio=audio_file, title=text)
+        except QueueFullError:
+            _refund_request_quota(chat_id, requester_id)
+            await update.message.reply_text(QUEUE_FULL_TEXT)
+        except Exception as e:
+            logger.error(f"Ошибка при загрузке музыки: {e}")
+            await update.message.reply_text("Не удалось загрузить музыку.")
+        finally:
+            if audio_filename and os.path.exists(audio_filename):
+                try:
+                    os.remove(audio_filename)
+                except Exception:
+                    pass
+        return
 
-        # 3) Music by query
-        if MUSIC_PATTERN.match(text):
-            audio_filename = None
-            try:
-                audio_filename = await asyncio.to_thread(download_music, text)
-                with open(audio_filename, "rb") as audio_file:
-                    await update.message.reply_audio(audio=audio_file, title=text)
-            except Exception as e:
-                logger.error(f"Ошибка при загрузке музыки: {e}")
-                await update.message.reply_text("Не удалось загрузить музыку.")
-            finally:
-                if audio_filename and os.path.exists(audio_filename):
-                    try:
-                        os.remove(audio_filename)
-                    except Exception:
-                        pass
-            return
+    # Otherwise ignore
+    return
 
-        # Otherwise ignore
-        return
+
+async def prune_quotas_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    USER_QUOTAS.prune()
+    CHAT_QUOTAS.prune()
 
 
 def build_application() -> Application:
     if not TOKEN:
         raise RuntimeError("Не найден TOKEN (или BOT_TOKEN) в .env")
 
-    app = ApplicationBuilder().token(TOKEN).build()
+    # handlers must run concurrently, otherwise the lanes and stages never overlap
+    builder = ApplicationBuilder().token(TOKEN).concurrent_updates(True).post_shutdown(_on_shutdown)
+    if TELEGRAM_API_BASE_URL:
+        builder = builder.base_url(f"{TELEGRAM_API_BASE_URL}/bot").base_file_url(f"{TELEGRAM_API_BASE_URL}/file/bot")
+        builder = builder.local_mode(TELEGRAM_LOCAL_MODE)
+        logger.info(f"Bot API: {TELEGRAM_API_BASE_URL} (local mode: {'да' if TELEGRAM_LOCAL_MODE else 'нет'})")
+    if TELEGRAM_UPLOAD_TIMEOUT_SECONDS > 0:
+        builder = builder.read_timeout(TELEGRAM_UPLOAD_TIMEOUT_SECONDS).media_write_timeout(TELEGRAM_UPLOAD_TIMEOUT_SECONDS)
+    app = builder.build()
 
     app.add_handler(CommandHandler("pechenyuha", pechenyuha_command))
     app.add_handler(CommandHandler("users", get_users_count))
+    app.add_handler(CommandHandler("cookies", cookies_status_command))
     app.add_handler(CommandHandler("start", start_command))
     app.add_handler(MessageHandler(filters.Document.ALL, handle_cookie_document))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
@@ -1544,13 +4343,21 @@ def build_application() -> Application:
     # Cache cleanup job
     if app.job_queue:
         app.job_queue.run_repeating(clean_cache_job, interval=CACHE_CLEAN_INTERVAL_SECONDS, first=10)
+        app.job_queue.run_repeating(prune_quotas_job, interval=600, first=600)
+        app.job_queue.run_repeating(flush_users_job, interval=USERS_FLUSH_INTERVAL_SECONDS, first=USERS_FLUSH_INTERVAL_SECONDS)
 
     return app
 
 
 def main() -> None:
+    # work dirs left over from a crash or restart; only our own, WORK_DIR may hold other files
+    for stale in WORK_DIR.glob("dl_*"):
+        if stale.is_dir() and not stale.is_symlink():
+            shutil.rmtree(stale, ignore_errors=True)
     _ensure_dirs()
-    _load_cache_index_from_disk()
+    _load_users()
+    _load_cache_index()
+    _load_cookie_health()
     auto_update_ytdlp()
 
     application = build_application()
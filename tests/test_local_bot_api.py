@@ -0,0 +1,140 @@
+"""Uploads against a fake Bot API server (http.server): file:// paths in local mode, multipart otherwise.
+
+main reads its configuration from the environment at import, so each mode sends from
+its own interpreter; the fake server runs in the test process and records the requests.
+
+    python -m pytest tests
+    python -m unittest discover tests
+"""
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import textwrap
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+
+# Sends one video and one two-video album the way the bot does after a download
+SENDER = textwrap.dedent(
+    """
+    import asyncio
+    import sys
+    from pathlib import Path
+    from types import SimpleNamespace
+
+    sys.path.insert(0, sys.argv[1])
+    import main
+    from telegram import Update
+
+    async def run() -> None:
+        app = main.build_application()
+        await app.bot.initialize()
+        update = Update.de_json(
+            {"update_id": 1, "message": {"message_id": 1, "date": 0, "chat": {"id": 1, "type": "private"}, "text": "x"}},
+            app.bot,
+        )
+        first, second = Path(sys.argv[2]), Path(sys.argv[3])
+        await main._send_single_item(update, None, kind="video", media=first, caption="c")
+        items = [{"kind": "video", "abs_path": str(first)}, {"kind": "video", "abs_path": str(second)}]
+        await main._send_media_group(update, SimpleNamespace(bot=app.bot), items=items, caption="c")
+        await app.bot.shutdown()
+
+    asyncio.run(run())
+    """
+)
+
+
+class _FakeBotApi(BaseHTTPRequestHandler):
+    requests: list[tuple[str, str, bytes]] = []
+
+    def do_POST(self) -> None:
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        method = self.path.rsplit("/", 1)[-1]
+        content_type = (self.headers.get("Content-Type") or "").split(";")[0].strip()
+        self.requests.append((method, content_type, body))
+
+        chat = {"id": 1, "type": "private"}
+
+        def message(n: int) -> dict:
+            video = {"file_id": f"V{n}", "file_unique_id": f"u{n}", "width": 1, "height": 1, "duration": 1}
+            return {"message_id": 10 + n, "date": 0, "chat": chat, "video": video}
+
+        if method == "getMe":
+            result = {"id": 5, "is_bot": True, "first_name": "bot", "username": "bot"}
+        elif method == "sendMediaGroup":
+            result = [message(1), message(2)]
+        else:
+            result = message(0)
+        payload = json.dumps({"ok": True, "result": result}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args) -> None:
+        pass
+
+
+class LocalBotApiUploadTest(unittest.TestCase):
+    def setUp(self) -> None:
+        _FakeBotApi.requests = []
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), _FakeBotApi)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmp = Path(tmp.name)
+        self.videos = [self.tmp / "a.mp4", self.tmp / "b.mp4"]
+        for video in self.videos:
+            video.write_bytes(b"\x00" * 1024)
+
+    def _send(self, *, local_mode: bool) -> dict[str, tuple[str, bytes]]:
+        env = {
+            **os.environ,
+            "TOKEN": "123:abc",
+            "TELEGRAM_API_BASE_URL": f"http://127.0.0.1:{self.server.server_port}",
+            "TELEGRAM_LOCAL_MODE": "1" if local_mode else "0",
+            "DATA_DIR": str(self.tmp / "data"),
+        }
+        subprocess.run(
+            [sys.executable, "-c", SENDER, str(REPO_DIR), *map(str, self.videos)],
+            cwd=self.tmp,
+            env=env,
+            check=True,
+            timeout=60,
+        )
+        return {method: (content_type, body) for method, content_type, body in _FakeBotApi.requests}
+
+    def test_local_mode_sends_file_uris(self) -> None:
+        sent = self._send(local_mode=True)
+
+        content_type, body = sent["sendVideo"]
+        self.assertEqual(content_type, "application/x-www-form-urlencoded")
+        self.assertEqual(parse_qs(body.decode())["video"], [self.videos[0].as_uri()])
+
+        content_type, body = sent["sendMediaGroup"]
+        self.assertEqual(content_type, "application/x-www-form-urlencoded")
+        media = json.loads(parse_qs(body.decode())["media"][0])
+        self.assertEqual([m["media"] for m in media], [v.as_uri() for v in self.videos])
+
+    def test_cloud_mode_uploads_multipart(self) -> None:
+        sent = self._send(local_mode=False)
+
+        for method in ("sendVideo", "sendMediaGroup"):
+            content_type, body = sent[method]
+            self.assertEqual(content_type, "multipart/form-data", method)
+            self.assertNotIn(b"file://", body, method)
+            self.assertIn(b"\x00" * 1024, body, method)
+
+
+if __name__ == "__main__":
+    unittest.main()